@@ -8,6 +8,10 @@ or unpack_double. In these cases, unpack_farray calls unpack_farray_float or
 unpack_farray_double, which precompile unpackers for the requested number of
 points, and use them for entire arrays.  This requires Python 2.5.
 
+The precompiled unpackers (Struct objects) are kept in one bounded cache for
+the module, shared by all Unpacker objects.  unpack_record() and unpack_into()
+decode a fixed record (several ints, for example) with one of them.
+
 Tim Mooney
 April, 2008
 
@@ -25,6 +29,18 @@ except ImportError:
 
 __all__ = ["Error", "Packer", "Unpacker", "ConversionError"]
 
+STRUCT_CACHE_SIZE = 256     # most Struct objects kept by getStruct()
+_structCache = {}           # format: Struct
+
+def getStruct(fmt):
+    """Struct object for format fmt, from a cache bounded to STRUCT_CACHE_SIZE formats."""
+    s = _structCache.get(fmt)
+    if s is None:
+        if len(_structCache) >= STRUCT_CACHE_SIZE:
+            _structCache.clear()
+        s = _structCache[fmt] = Struct(fmt)
+    return s
+
 # exceptions
 class Error(Exception):
     """Exception class for this module. Use:
@@ -131,9 +147,6 @@ class Unpacker:
 
     def __init__(self, data):
         self.reset(data)
-        self.unpackFloatDict = {}
-        self.unpackDoubleDict = {}
-        self.unpackIntDict = {}
 
     def reset(self, data):
         self.__buf = data
@@ -253,28 +266,31 @@ class Unpacker:
             return self.standard_unpack_farray(n, unpack_item)
 
     def unpack_farray_float(self, n):
-        if not self.unpackFloatDict.has_key(n):
-            fmt = ">" + "f"*n
-            self.unpackFloatDict[n] = Struct(fmt).unpack
-        i = self.__pos
-        self.__pos = j = i+4*n
-        return self.unpackFloatDict[n](self.__buf[i:j])
+        return self.unpack_record('>%df' % n)
         
     def unpack_farray_double(self, n):
-        if not self.unpackDoubleDict.has_key(n):
-            fmt = ">" + "d"*n
-            self.unpackDoubleDict[n] = Struct(fmt).unpack
-        i = self.__pos
-        self.__pos = j = i+8*n
-        return self.unpackDoubleDict[n](self.__buf[i:j])
+        return self.unpack_record('>%dd' % n)
 
     def unpack_farray_int(self, n):
-        if not self.unpackIntDict.has_key(n):
-            fmt = ">" + "l"*n
-            self.unpackIntDict[n] = Struct(fmt).unpack
+        return self.unpack_record('>%dl' % n)
+
+    def unpack_record(self, fmt):
+        """Decode the record of struct format fmt (big-endian, e.g. '>3l') at the
+        current position, return the tuple of its values."""
+        s = getStruct(fmt)
         i = self.__pos
-        self.__pos = j = i+4*n
-        return self.unpackIntDict[n](self.__buf[i:j])
+        j = i + s.size
+        data = self.__buf[i:j]
+        if len(data) < s.size:
+            raise EOFError
+        self.__pos = j
+        return s.unpack(data)
+
+    def unpack_into(self, obj, names, fmt):
+        """Decode the record of struct format fmt and set attribute names[k]
+        of obj to its k-th value, e.g. unpack_into(scan, ('np', 'nd', 'nt'), '>3l')."""
+        for name, value in zip(names, self.unpack_record(fmt)):
+            setattr(obj, name, value)
 
     def unpack_array(self, unpack_item):
         n = self.unpack_uint()
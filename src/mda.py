@@ -17,6 +17,11 @@ __version__ = '2.1'
 import sys
 import os
 import string
+import mmap
+import array
+import struct
+import ast
+import re
 
 have_fast_xdr = False
 try:
@@ -50,6 +55,7 @@ use_numpy = have_numpy
 # return data in numpy arrays.  Otherwise, we'll return data in lists.
 
 import copy
+import UserDict
 
 ################################################################################
 # classes
@@ -173,14 +179,6 @@ class scanBuf:
         self.data = None
         self.inner = []    # inner scans, if any
 
-# mdaBuf is a private data structure used to assemble data that will be written to an MDA file.
-class mdaBuf:
-    def __init__(self):
-        self.header = None
-        self.pExtra = None    # file offset to extraPV section
-        self.scan = None
-        self.extraPV = None    # extraPV section
-
 ################################################################################
 # read MDA file
 
@@ -222,24 +220,29 @@ def verboseData(data, out=sys.stdout):
                 out.write(" %.5f" % datum)
         out.write(" ]\n")
 
-def readScan(scanFile, verbose=0, out=sys.stdout, unpacker=None):
-    """usage: (scan,num) = readScan(scanFile, verbose=0, out=sys.stdout)"""
-
-    scan = scanDim()    # data structure to hold scan info and data
-    buf = scanFile.read(100000) # enough to read scan header
-    if unpacker == None:
-        u = xdr.Unpacker(buf)
+# Fixed fields of a scan header (XDR ints, in file order), each decoded with
+# one unpack: unpackScanFields(u, scan, scanStartFields)
+scanStartFields = ('rank', 'npts', 'curr_pt')
+scanCountFields = ('np', 'nd', 'nt')
+def unpackScanFields(u, scan, names):
+    if have_fast_xdr:
+        u.unpack_into(scan, names, '>%dl' % len(names))
     else:
-        u = unpacker
-        u.reset(buf)
+        for name in names:
+            setattr(scan, name, u.unpack_int())
 
-    scan.rank = u.unpack_int()
+def readScanHeader(u, verbose=0, out=sys.stdout):
+    """usage: (scan, detPosition, dataPosition) = readScanHeader(u, verbose=0, out=sys.stdout)
+
+    Parse the scan header at the current position of unpacker u.  Returns the
+    scan (no data) and the unpacker positions of the detector descriptions and
+    of the data block, or None if the header does not look like a scan.
+    """
+    scan = scanDim()    # data structure to hold scan info and data
+    unpackScanFields(u, scan, scanStartFields)
     if (scan.rank > 20) or (scan.rank < 0):
-        print "* * * readScan('%s'): rank > 20.  probably a corrupt file" % scanFile.name
         return None
 
-    scan.npts = u.unpack_int()
-    scan.curr_pt = u.unpack_int()
     if verbose:
         print "scan.rank = ", `scan.rank`
         print "scan.npts = ", `scan.npts`
@@ -259,12 +262,11 @@ def readScan(scanFile, verbose=0, out=sys.stdout, unpacker=None):
     timelength = u.unpack_int()
     scan.time = u.unpack_string()
     if verbose: print "scan.time = ", `scan.time`
-    scan.np = u.unpack_int()
-    if verbose: print "scan.np = ", `scan.np`
-    scan.nd = u.unpack_int()
-    if verbose: print "scan.nd = ", `scan.nd`
-    scan.nt = u.unpack_int()
-    if verbose: print "scan.nt = ", `scan.nt`
+    unpackScanFields(u, scan, scanCountFields)
+    if verbose:
+        print "scan.np = ", `scan.np`
+        print "scan.nd = ", `scan.nd`
+        print "scan.nt = ", `scan.nt`
     for j in range(scan.np):
         scan.p.append(scanPositioner())
         scan.p[j].number = u.unpack_int()
@@ -292,7 +294,7 @@ def readScan(scanFile, verbose=0, out=sys.stdout, unpacker=None):
         if length: scan.p[j].readback_unit = u.unpack_string()
         if verbose: print "scan.p[%d].readback_unit = %s" % (j, `scan.p[j].readback_unit`)
 
-    file_loc_det = scanFile.tell() - (len(buf) - u.get_position())
+    detPosition = u.get_position()
 
     for j in range(scan.nd):
         scan.d.append(scanDetector())
@@ -319,42 +321,79 @@ def readScan(scanFile, verbose=0, out=sys.stdout, unpacker=None):
         scan.t[j].command = u.unpack_float()
         if verbose: print "scan.t[%d].command = %s" % (j, `scan.t[j].command`)
 
+    return (scan, detPosition, u.get_position())
+
+def readScan(scanFile, verbose=0, out=sys.stdout, unpacker=None, useNumpy=False):
+    """usage: (scan,num) = readScan(scanFile, verbose=0, out=sys.stdout, useNumpy=False)"""
+
+    buf = scanFile.read(100000) # enough to read scan header
+    if unpacker == None:
+        u = xdr.Unpacker(buf)
+    else:
+        u = unpacker
+        u.reset(buf)
+
+    header = readScanHeader(u, verbose, out)
+    if header == None:
+        print "* * * readScan('%s'): rank > 20.  probably a corrupt file" % scanFile.name
+        return None
+    (scan, detPosition, dataPosition) = header
+    file_loc_det = scanFile.tell() - (len(buf) - detPosition)
+
     ### read data
     # positioners
-    file_loc_data = scanFile.tell() - (len(buf) - u.get_position())
+    file_loc_data = scanFile.tell() - (len(buf) - dataPosition)
     scanFile.seek(file_loc_data)
     buf = scanFile.read(scan.npts * (scan.np * 8 + scan.nd *4))
-    u.reset(buf)
+    (pData, dData) = unpackScanData(buf, 0, scan.npts, scan.np, scan.nd, useNumpy)
+    for j in range(scan.np):
+        scan.p[j].data = pData[j]
+    for j in range(scan.nd):
+        scan.d[j].data = dData[j]
+
+    return (scan, (file_loc_data-file_loc_det))
+
+def unpackScanData(buf, offset, npts, np, nd, useNumpy=False):
+    """usage: (pData, dData) = unpackScanData(buf, offset, npts, np, nd, useNumpy=False)
 
+    Decode the data block that starts at 'offset' in buf: np positioner arrays
+    (double), then nd detector arrays (float), each npts long.  Returns the list
+    of positioner arrays and the list of detector arrays.
+
+    With useNumpy, the block is interpreted directly as big-endian numpy arrays
+    (no Python float is created for each value), byteswapped once to native
+    order, and each positioner and detector gets a view (one row) of the result.
+    """
+    if useNumpy and have_numpy:
+        pData = numpy.frombuffer(buf, dtype='>f8', count=npts*np, offset=offset)
+        dData = numpy.frombuffer(buf, dtype='>f4', count=npts*nd, offset=offset+8*npts*np)
+        pData = pData.astype('=f8').reshape(np, npts)
+        dData = dData.astype('=f4').reshape(nd, npts)
+        return (list(pData), list(dData))
+
+    u = xdr.Unpacker(buf)
+    u.set_position(offset)
     if have_fast_xdr:
-        data = u.unpack_farray_double(scan.npts*scan.np)
+        data = u.unpack_farray_double(npts*np)
     else:
-        data = u.unpack_farray(scan.npts*scan.np, u.unpack_double)
-    start = 0
-    end = scan.npts
-    for j in range(scan.np):
-        start = j*scan.npts
-        scan.p[j].data = data[start:end]
-        start = end
-        end += scan.npts
-        
-    # detectors
+        data = u.unpack_farray(npts*np, u.unpack_double)
+    pData = [data[j*npts : (j+1)*npts] for j in range(np)]
     if have_fast_xdr:
-        data = u.unpack_farray_float(scan.npts*scan.nd)
+        data = u.unpack_farray_float(npts*nd)
     else:
-        data = u.unpack_farray(scan.npts*scan.nd, u.unpack_float)
-    start = 0
-    end = scan.npts
-    for j in range(scan.nd):
-        scan.d[j].data = data[start:end]
-        start = end
-        end += scan.npts
-
-    return (scan, (file_loc_data-file_loc_det))
+        data = u.unpack_farray(npts*nd, u.unpack_float)
+    dData = [data[j*npts : (j+1)*npts] for j in range(nd)]
+    return (pData, dData)
 
 useDetToDatOffset = 1
-def readScanQuick(scanFile, unpacker=None, detToDat_offset=None):
-    """usage: readScanQuick(scanFile, unpacker=None)"""
+def readScanQuick(scanFile, unpacker=None, detToDat_offset=None, useNumpy=False):
+    """usage: scan = readScanQuick(scanFile, unpacker=None, detToDat_offset=None, useNumpy=False)
+
+    Like readScan(), but the description strings are skipped, not decoded.
+    With detToDat_offset (from readScan() of a scan of the same dimension),
+    the detector and trigger descriptions are not even skipped.  For whole
+    files, readMDA(readQuick=True) finds the data of all inner scans faster.
+    """
 
     scan = scanDim()    # data structure to hold scan info and data
     buf = scanFile.read(10000) # enough to read scan header
@@ -364,14 +403,11 @@ def readScanQuick(scanFile, unpacker=None, detToDat_offset=None):
         u = unpacker
         u.reset(buf)
 
-    scan.rank = u.unpack_int()
+    unpackScanFields(u, scan, scanStartFields)
     if (scan.rank > 20) or (scan.rank < 0):
         print "* * * readScanQuick('%s'): rank > 20.  probably a corrupt file" % scanFile.name
         return None
 
-    scan.npts = u.unpack_int()
-    scan.curr_pt = u.unpack_int()
-
     if (scan.rank > 1):
         if have_fast_xdr:
             scan.plower_scans = u.unpack_farray_int(scan.npts)
@@ -383,9 +419,7 @@ def readScanQuick(scanFile, unpacker=None, detToDat_offset=None):
     timelength = u.unpack_int()
     scan.time = u.unpack_string()
 
-    scan.np = u.unpack_int()
-    scan.nd = u.unpack_int()
-    scan.nt = u.unpack_int()
+    unpackScanFields(u, scan, scanCountFields)
 
     for j in range(scan.np):
         scan.p.append(scanPositioner())
@@ -430,9 +464,6 @@ def readScanQuick(scanFile, unpacker=None, detToDat_offset=None):
         # positioners
 
         file_loc = scanFile.tell() - (len(buf) - u.get_position())
-        diff = file_loc - (file_loc_det + detToDat_offset)
-        if diff != 0:
-            print "oldSeek, newSeek, o-n=", file_loc, file_loc_det + detToDat_offset, diff
         scanFile.seek(file_loc)
     else:
         for j in range(scan.nd):
@@ -440,26 +471,289 @@ def readScanQuick(scanFile, unpacker=None, detToDat_offset=None):
         scanFile.seek(file_loc_det + detToDat_offset)
 
     buf = scanFile.read(scan.npts * (scan.np * 8 + scan.nd *4))
-    u.reset(buf)
-
-    if have_fast_xdr:
-        data = u.unpack_farray_double(scan.npts*scan.np)
-    else:
-        data = u.unpack_farray(scan.npts*scan.np, u.unpack_double)
+    (pData, dData) = unpackScanData(buf, 0, scan.npts, scan.np, scan.nd, useNumpy)
     for j in range(scan.np):
-        start = j*scan.npts
-        scan.p[j].data = data[j*scan.npts : (j+1)*scan.npts]
-
-    # detectors
-    if have_fast_xdr:
-        data = u.unpack_farray_float(scan.npts*scan.nd)
-    else:
-        data = u.unpack_farray(scan.npts*scan.nd, u.unpack_float)
+        scan.p[j].data = pData[j]
     for j in range(scan.nd):
-        scan.d[j].data = data[j*scan.npts : (j+1)*scan.npts]
+        scan.d[j].data = dData[j]
 
     return scan
 
+# Skip over an XDR string that is preceded by its (redundant) length, as in the
+# positioner/detector/trigger descriptions of a scan header.
+def skipHeaderString(u):
+    n = u.unpack_int()
+    if n: u.set_position(u.get_position()+4+(n+3)//4*4)
+
+# the scan name and time are always written as XDR strings, even when empty
+def skipScanString(u):
+    n = u.unpack_int()
+    u.set_position(u.get_position()+4+(n+3)//4*4)
+
+def locateScanData(u, offset):
+    """usage: (scan, dataOffset) = locateScanData(u, offset)
+
+    Parse just enough of the scan header that starts at file offset 'offset' to
+    find its data block.  The unpacker u must hold the whole file (e.g., an mmap).
+    The returned scan has rank, npts, curr_pt, plower_scans, np, nd, and nt, but
+    no positioner, detector, or trigger descriptions and no data.
+    """
+    scan = scanDim()
+    u.set_position(offset)
+    unpackScanFields(u, scan, scanStartFields)
+    if (scan.rank > 20) or (scan.rank < 0):
+        print "* * * locateScanData(offset=%d): rank > 20.  probably a corrupt file" % offset
+        return None
+    if (scan.rank > 1):
+        if have_fast_xdr:
+            scan.plower_scans = u.unpack_farray_int(scan.npts)
+        else:
+            scan.plower_scans = u.unpack_farray(scan.npts, u.unpack_int)
+    skipScanString(u)    # name
+    skipScanString(u)    # time
+    unpackScanFields(u, scan, scanCountFields)
+    for j in range(scan.np):
+        u.unpack_int()    # number
+        for k in range(7):    # name, desc, step_mode, unit, readback_name, readback_desc, readback_unit
+            skipHeaderString(u)
+    for j in range(scan.nd):
+        u.unpack_int()    # number
+        for k in range(3):    # name, desc, unit
+            skipHeaderString(u)
+    for j in range(scan.nt):
+        u.unpack_int()    # number
+        skipHeaderString(u)    # name
+        u.unpack_float()    # command
+    return (scan, u.get_position())
+
+def scanHeaderSignature(u, offset):
+    """usage: (scan, signature) = scanHeaderSignature(u, offset)
+
+    The fields of the scan header at 'offset' that locateScanData() returns,
+    without skipping the descriptions, and the values that fix the size of the
+    header up to the descriptions: (rank, npts, name and time lengths, np, nd,
+    nt).  Inner scans of one dimension share the descriptions, so scans with
+    the same signature have headers of the same size.
+    """
+    scan = scanDim()
+    u.set_position(offset)
+    unpackScanFields(u, scan, scanStartFields)
+    if (scan.rank > 20) or (scan.rank < 0):
+        return None
+    if (scan.rank > 1):
+        if have_fast_xdr:
+            scan.plower_scans = u.unpack_farray_int(scan.npts)
+        else:
+            scan.plower_scans = u.unpack_farray(scan.npts, u.unpack_int)
+    nameLength = u.unpack_int()
+    u.set_position(u.get_position()+4+(nameLength+3)//4*4)
+    timeLength = u.unpack_int()
+    u.set_position(u.get_position()+4+(timeLength+3)//4*4)
+    unpackScanFields(u, scan, scanCountFields)
+    return (scan, (scan.rank, scan.npts, nameLength, timeLength, scan.np, scan.nd, scan.nt))
+
+def scanHeaderStride(u, first, last):
+    """usage: (stride, signature) = scanHeaderStride(u, first, last)
+
+    Distance from the header to the data of the scans at offsets 'first' and
+    'last' (the first and last scans of one dimension), parsing both headers
+    completely, and their signature (see scanHeaderSignature()).  Returns
+    None if the two headers differ in size or signature.
+    """
+    found = [locateScanData(u, first), locateScanData(u, last)]
+    signatures = [scanHeaderSignature(u, first), scanHeaderSignature(u, last)]
+    if (None in found) or (None in signatures):
+        return None
+    stride = found[0][1] - first
+    if (found[1][1] - last != stride) or (signatures[0][1] != signatures[1][1]):
+        return None
+    return (stride, signatures[0][1])
+
+# Append one row of data to the nested lists of a multi-dimensional array, at
+# the position given by its coordinate in the outer dimensions (file order).
+# [ [1,2,3], [2,3,4] ] -> [ [1,2,3], [2,3,4], [3,4,5] ]
+def appendNested(data, coord, row):
+    target = data
+    for i in coord[:-1]:
+        if len(target) <= i:
+            target.append([])
+        target = target[i]
+    target.append(row)
+
+# append the data arrays of one inner scan (at N-D coordinate coord) to the
+# nested data lists of the first scan of its dimension
+def appendScanData(scan, coord, pData, dData):
+    numP = min(len(pData), len(scan.p))
+    if (len(pData) > numP):
+        print "First scan had %d positioners; This one only has %d." % (len(pData), numP)
+    for j in range(numP): appendNested(scan.p[j].data, coord, pData[j])
+    numD = min(len(dData), len(scan.d))
+    if (len(dData) > numD):
+        print "First scan had %d detectors; This one only has %d." % (len(dData), numD)
+    for j in range(numD): appendNested(scan.d[j].data, coord, dData[j])
+
+class MdaIndex:
+    """
+    usage: index = MdaIndex(u, pmain_scan, maxdim=4)   (or: index = indexMDA(fname))
+
+    File offsets of every scan in an MDA file, found in a single traversal of
+    the plower_scans tree; each scan header is parsed exactly once.  The
+    unpacker u must hold the whole file (e.g., an mmap).
+
+    For each dimension (index.offset[0] is dimension 1, the outermost scan)
+    there is one entry per scan, in file order, kept in compact arrays:
+
+        offset[k][e]      file offset of the scan header
+        dataOffset[k][e]  file offset of the data block
+        curr_pt[k][e], npts[k][e], np[k][e], nd[k][e]
+        first[k][e]       entry (in dimension k+2) of this scan's first inner scan
+
+    Any inner scan can be reached by its N-D coordinate, e.g. for a 3-D file:
+
+        (dimNum, e) = index.entry((i, j))    # scan j of 2D scan i -> (3, e)
+        scan = index.readRow((i, j))         # header and data of that scan
+
+    With quick=True, only the first and last scan headers of each dimension
+    are parsed completely.  If their data are at the same distance from the
+    header (see scanHeaderStride()), the data of every other scan with the
+    same header signature is found at that distance from its header offset
+    (plower_scans[i] + stride), reading just the fixed header fields.  Scans
+    that do not match are parsed completely.
+    """
+    def __init__(self, u, pmain_scan, maxdim=4, quick=False):
+        self.u = u
+        self.offset = []
+        self.dataOffset = []
+        self.curr_pt = []
+        self.npts = []
+        self.np = []
+        self.nd = []
+        self.first = []
+
+        offsets = array.array('l', [pmain_scan])
+        while len(offsets) and len(self.offset) < maxdim:
+            inner = len(self.offset) + 1 < maxdim
+            level = [array.array('l') for i in range(7)]
+            (offset, dataOffset, curr_pt, npts, np, nd, first) = level
+            nextOffsets = array.array('l')
+            stride = None
+            if quick and (len(offsets) > 2):
+                stride = scanHeaderStride(u, offsets[0], offsets[-1])
+            for off in offsets:
+                found = None
+                if stride != None:
+                    found = self.locateQuick(off, stride)
+                if found == None:
+                    found = locateScanData(u, off)
+                if found == None:
+                    (s, dataPosition) = (scanDim(), 0)
+                else:
+                    (s, dataPosition) = found
+                offset.append(off)
+                dataOffset.append(dataPosition)
+                curr_pt.append(s.curr_pt)
+                npts.append(s.npts)
+                np.append(s.np)
+                nd.append(s.nd)
+                first.append(len(nextOffsets))
+                if inner and (s.rank > 1):
+                    # if curr_pt < npts, the rest of plower_scans is garbage
+                    nextOffsets.extend(s.plower_scans[:min(s.curr_pt, s.npts)])
+            self.offset.append(offset)
+            self.dataOffset.append(dataOffset)
+            self.curr_pt.append(curr_pt)
+            self.npts.append(npts)
+            self.np.append(np)
+            self.nd.append(nd)
+            self.first.append(first)
+            offsets = nextOffsets
+        self.rank = len(self.offset)    # number of dimensions indexed
+
+    def locateQuick(self, offset, stride):
+        """(scan, dataOffset) as locateScanData(), for a header of known size,
+        or None if the header's signature or data do not fit"""
+        found = scanHeaderSignature(self.u, offset)
+        if (found == None) or (found[1] != stride[1]):
+            return None
+        scan = found[0]
+        dataOffset = offset + stride[0]
+        if dataOffset + scan.npts * (scan.np * 8 + scan.nd * 4) > len(self.u.get_buffer()):
+            return None
+        return (scan, dataOffset)
+
+    def entries(self, dimNum):
+        """number of scans of dimension dimNum (1 = outermost) in the file"""
+        return len(self.offset[dimNum-1])
+
+    def innerScans(self, dimNum, e):
+        """number of (indexed) inner scans of scan e of dimension dimNum"""
+        k = dimNum-1
+        if k+1 >= self.rank:
+            return 0
+        if e+1 < len(self.first[k]):
+            return self.first[k][e+1] - self.first[k][e]
+        return len(self.offset[k+1]) - self.first[k][e]
+
+    def entry(self, coord):
+        """usage: (dimNum, e) = index.entry(coord)
+
+        the scan at N-D coordinate coord (one index per outer dimension, so
+        coord=() is the outermost scan)"""
+        e = 0
+        for k in range(len(coord)):
+            if not (0 <= coord[k] < self.innerScans(k+1, e)):
+                raise IndexError("coordinate %s not in file" % str(coord))
+            e = self.first[k][e] + coord[k]
+        return (len(coord)+1, e)
+
+    def coordinates(self, dimNum):
+        """N-D coordinates of all scans of dimension dimNum, in file (entry) order"""
+        coords = [()]
+        for k in range(1, dimNum):
+            coords = [coords[e] + (i,) for e in range(len(coords)) for i in range(self.innerScans(k, e))]
+        return coords
+
+    def rowData(self, dimNum, e, useNumpy=False):
+        """usage: (pData, dData) = index.rowData(dimNum, e, useNumpy=False)"""
+        k = dimNum-1
+        return unpackScanData(self.u.get_buffer(), self.dataOffset[k][e],
+            self.npts[k][e], self.np[k][e], self.nd[k][e], useNumpy)
+
+    def readRow(self, coord, useNumpy=False, verbose=0, out=sys.stdout):
+        """usage: scan = index.readRow(coord, useNumpy=False)
+
+        header and data of the scan at N-D coordinate coord"""
+        (dimNum, e) = self.entry(coord)
+        self.u.set_position(self.offset[dimNum-1][e])
+        (scan, detPosition, dataPosition) = readScanHeader(self.u, verbose, out)
+        scan.dim = dimNum
+        (pData, dData) = unpackScanData(self.u.get_buffer(), dataPosition, scan.npts, scan.np, scan.nd, useNumpy)
+        for j in range(scan.np):
+            scan.p[j].data = pData[j]
+        for j in range(scan.nd):
+            scan.d[j].data = dData[j]
+        return scan
+
+    def close(self):
+        """close the memory map opened by indexMDA()"""
+        self.u.get_buffer().close()
+
+def indexMDA(fname, maxdim=4, quick=False):
+    """usage: index = indexMDA(fname, maxdim=4, quick=False)
+
+    MdaIndex of an MDA file; the file stays memory-mapped (for index.readRow())
+    until index.close()
+    """
+    scanFile = open(fname, 'rb')
+    buf = mmap.mmap(scanFile.fileno(), 0, access=mmap.ACCESS_READ)
+    scanFile.close()
+    u = xdr.Unpacker(buf)
+    (version, scan_number, rank, dimensions, isRegular, pExtra) = unpackFileHeader(u)
+    if abs(version - 1.3) > .01:
+        buf.close()
+        raise IOError("indexMDA: can't read MDA version %f.  Is %s really an MDA file?" % (version, fname))
+    return MdaIndex(u, u.get_position(), min(rank, maxdim), quick)
+
 EPICS_types_dict = {
 0: "DBR_STRING",
 1: "DBR_SHORT",
@@ -504,8 +798,189 @@ def EPICS_types(n):
     else:
         return ("Unexpected type %d" % n)
 
-def readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=None, readQuick=False):
-    """usage readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=None, readQuick=False)"""
+# Decode the scan-environment ("extra" PV) section, starting at the current
+# position of unpacker u, into dict (name: (desc, unit, value, EPICS_type, count)).
+# With names, only the PVs in names are decoded, the others are skipped.
+def readExtraPVs(u, dict, verbose=0, out=sys.stdout, names=None):
+    numExtra = u.unpack_int()
+    if verbose: out.write("\nnumber of 'Extra' PV's = %d\n" % numExtra)
+    for i in range(numExtra):
+        if verbose: out.write("env PV #%d -------\n" % (i))
+        (name, desc, EPICS_type, count, unit) = unpackExtraPVHead(u, verbose, out)
+        if (names != None) and (name not in names):
+            skipExtraPVValue(u, EPICS_type, count)
+            continue
+        value = unpackExtraPVValue(u, EPICS_type, count, verbose, out)
+        dict[name] = (desc, unit, value, EPICS_type, count)
+
+# Positions in unpacker u of each scan-environment PV, by name, without
+# decoding any values.  u is at the start of the section.
+def indexExtraPVs(u):
+    positions = {}
+    numExtra = u.unpack_int()
+    for i in range(numExtra):
+        position = u.get_position()
+        (name, desc, EPICS_type, count, unit) = unpackExtraPVHead(u)
+        skipExtraPVValue(u, EPICS_type, count)
+        positions[name] = position
+    return positions
+
+# usage: (name, (desc, unit, value, EPICS_type, count)) = unpackExtraPV(u)
+def unpackExtraPV(u):
+    (name, desc, EPICS_type, count, unit) = unpackExtraPVHead(u)
+    value = unpackExtraPVValue(u, EPICS_type, count)
+    return (name, (desc, unit, value, EPICS_type, count))
+
+# usage: (name, desc, EPICS_type, count, unit) = unpackExtraPVHead(u, verbose=0, out=sys.stdout)
+def unpackExtraPVHead(u, verbose=0, out=sys.stdout):
+    name = ''
+    n = u.unpack_int()      # length of name string
+    if n: name = u.unpack_string()
+    if verbose: out.write("\tname = '%s'\n" % name)
+    desc = ''
+    n = u.unpack_int()      # length of desc string
+    if n: desc = u.unpack_string()
+    if verbose: out.write("\tdesc = '%s'\n" % desc)
+    EPICS_type = u.unpack_int()
+    if verbose: out.write("\tEPICS_type = %d (%s)\n" % (EPICS_type, EPICS_types(EPICS_type)))
+
+    unit = ''
+    count = 0
+    if EPICS_type != 0:   # not DBR_STRING; array is permitted
+        count = u.unpack_int()  # 
+        if verbose: out.write("\tcount = %d\n" % count)
+        n = u.unpack_int()      # length of unit string
+        if n: unit = u.unpack_string()
+        if verbose: out.write("\tunit = '%s'\n" % unit)
+    return (name, desc, EPICS_type, count, unit)
+
+def unpackExtraPVValue(u, EPICS_type, count, verbose=0, out=sys.stdout):
+    value = ''
+    if EPICS_type == 0: # DBR_STRING
+        n = u.unpack_int()      # length of value string
+        if n: value = u.unpack_string()
+    elif EPICS_type == 32: # DBR_CTRL_CHAR
+        value = unpackCharArray(u, count)
+    elif EPICS_type == 29: # DBR_CTRL_SHORT
+        value = u.unpack_farray(count, u.unpack_int)
+    elif EPICS_type == 33: # DBR_CTRL_LONG
+        value = u.unpack_farray(count, u.unpack_int)
+    elif EPICS_type == 30: # DBR_CTRL_FLOAT
+        value = u.unpack_farray(count, u.unpack_float)
+    elif EPICS_type == 34: # DBR_CTRL_DOUBLE
+        value = u.unpack_farray(count, u.unpack_double)
+    if verbose:
+        if (EPICS_type == 0):
+            out.write("\tvalue = '%s'\n" % (value))
+        else:
+            out.write("\tvalue = ")
+            verboseData(value, out)
+    return value
+
+# DBR_CTRL_CHAR array: one character in each XDR int, treated as a
+# null-terminated string.  The characters are sliced out of the buffer in one
+# step; only ints outside 0..255 need the slow path (and raise, as chr() does).
+def unpackCharArray(u, count):
+    start = u.get_position()
+    end = start + 4*count
+    raw = u.get_buffer()[start:end]
+    if len(raw) < 4*count:
+        raise EOFError
+    high = raw[0::4] + raw[1::4] + raw[2::4]
+    if high.count('\0') == len(high):
+        u.set_position(end)
+        return raw[3::4].split('\0', 1)[0]
+    vect = u.unpack_farray(count, u.unpack_int)
+    value = []
+    for c in vect:
+        if c == 0: break
+        value.append(chr(c))
+    return ''.join(value)
+
+# bytes of each value in the scan-environment section, by EPICS_type
+# (XDR packs CHAR and SHORT in 4 bytes, as int)
+extraPVValueSize = {32: 4, 29: 4, 33: 4, 30: 4, 34: 8}
+
+def skipExtraPVValue(u, EPICS_type, count):
+    if EPICS_type == 0: # DBR_STRING
+        skipHeaderString(u)
+    else:
+        u.set_position(u.get_position() + count * extraPVValueSize.get(EPICS_type, 0))
+
+class lazyEnvDict(UserDict.DictMixin):
+    """
+    usage: dict = lazyEnvDict(header, buf, positions)
+
+    The file-level dictionary (dim[0]) of readMDA(..., env='lazy'): all keys are
+    present, but a scan-environment PV is decoded from buf (the bytes of the
+    section) the first time it is used.  The PVs not yet decoded are kept in
+    their own table, so dict(d), other.update(d), copies and pickles all get
+    the decoded values.
+    """
+    def __init__(self, header, buf, positions):
+        self.data = dict(header)
+        self.buf = buf
+        self.undecoded = {}    # name: position in buf
+        for name, position in positions.items():
+            if name not in header:
+                self.undecoded[name] = position
+
+    def decode(self, name):
+        u = xdr.Unpacker(self.buf)
+        u.set_position(self.undecoded.pop(name))
+        self.data[name] = unpackExtraPV(u)[1]
+
+    def decodeAll(self):
+        for name in self.undecoded.keys():
+            self.decode(name)
+
+    def __getitem__(self, name):
+        if name in self.undecoded: self.decode(name)
+        return self.data[name]
+
+    def __setitem__(self, name, value):
+        self.undecoded.pop(name, None)
+        self.data[name] = value
+
+    def __delitem__(self, name):
+        if name in self.undecoded:
+            del self.undecoded[name]
+        else:
+            del self.data[name]
+
+    def keys(self):
+        return self.data.keys() + self.undecoded.keys()
+
+    def __contains__(self, name):
+        return (name in self.data) or (name in self.undecoded)
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.data) + len(self.undecoded)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __reduce__(self):
+        return (dict, (self.items(),))
+
+def readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=None, readQuick=False, env=True):
+    """usage readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=None, readQuick=False, env=True)
+
+    With readQuick, the inner scans are located from their header offsets and
+    the header size of the first and last scan of each dimension (see
+    MdaIndex), rather than by parsing every header.
+
+    env selects the scan-environment PVs put in dim[0]:
+        True      - all of them (default)
+        False     - none, the section is not read
+        [names]   - only these PVs (others are skipped, not decoded)
+        'lazy'    - all of them, each decoded the first time it is used
+    """
     global use_numpy
 
     if useNumpy and not have_numpy:
@@ -570,7 +1045,7 @@ def readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=
 
     # collect 1D data
     scanFile.seek(pmain_scan)
-    (s,n) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
+    (s,n) = readScan(scanFile, max(0,verbose-1), out, unpacker=u, useNumpy=use_numpy)
     dim.append(s)
     dim[0].dim = 1
 
@@ -581,197 +1056,45 @@ def readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=
             d.data = numpy.array(d.data)
 
     if ((rank > 1) and (maxdim > 1)):
-        # collect 2D data
-        for i in range(dim[0].curr_pt):
-            scanFile.seek(dim[0].plower_scans[i])
-            if (i==0):
-                (s,detToDat) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
-                dim.append(s)
-                dim[1].dim = 2
-                # replace data arrays [1,2,3] with [[1,2,3]]
-                for j in range(dim[1].np):
-                    dim[1].p[j].data = [dim[1].p[j].data]
-                for j in range(dim[1].nd):
-                    dim[1].d[j].data = [dim[1].d[j].data]
-            else:
-                if readQuick:
-                    s = readScanQuick(scanFile, unpacker=u, detToDat_offset=detToDat)
-                else:
-                    (s,junk) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
-                # append data arrays
-                # [ [1,2,3], [2,3,4] ] -> [ [1,2,3], [2,3,4], [3,4,5] ]
-                numP = min(s.np, len(dim[1].p))
-                if (s.np > numP):
-                    print "First scan had %d positioners; This one only has %d." % (s.np, numP)
-                for j in range(numP): dim[1].p[j].data.append(s.p[j].data)
-                numD = min(s.nd, len(dim[1].d))
-                if (s.nd > numD):
-                    print "First scan had %d detectors; This one only has %d." % (s.nd, numD)
-                for j in range(numD): dim[1].d[j].data.append(s.d[j].data)
-        if use_numpy:
-            for p in dim[1].p:
-                p.data = numpy.array(p.data)
-            for d in dim[1].d:
-                d.data = numpy.array(d.data)
-
-    if ((rank > 2) and (maxdim > 2)):
-        # collect 3D data
-        #print "dim[0].curr_pt=",dim[0].curr_pt
-        for i in range(dim[0].curr_pt):
-            #print "i=%d of %d points" % (i, dim[0].curr_pt)
-            scanFile.seek(dim[0].plower_scans[i])
-            (s1,detToDat) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
-            #print "s1.curr_pt=", s1.curr_pt
-            for j in range(s1.curr_pt):
-                #print "j=%d of %d points" % (j, s1.curr_pt)
-                scanFile.seek(s1.plower_scans[j])
-                if (j==0) or not readQuick:
-                    (s, detToDat) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
+        # One traversal of the plower_scans tree finds every inner scan;
+        # each dimension is then collected from that index.
+        mm = mmap.mmap(scanFile.fileno(), 0, access=mmap.ACCESS_READ)
+        index = MdaIndex(xdr.Unpacker(mm), pmain_scan, min(rank, maxdim), readQuick)
+        for dimNum in range(2, index.rank+1):
+            coords = index.coordinates(dimNum)
+            for e in range(len(coords)):
+                if (e == 0):
+                    scan = index.readRow(coords[0], use_numpy, max(0,verbose-1), out)
+                    dim.append(scan)
+                    # replace data arrays [1,2,3] with [[1,2,3]], [[[1,2,3]]], ...
+                    for p in scan.p + scan.d:
+                        row = p.data
+                        p.data = []
+                        appendNested(p.data, coords[0], row)
                 else:
-                    s = readScanQuick(scanFile, unpacker=u, detToDat_offset=detToDat)
-                if ((i == 0) and (j == 0)):
-                    dim.append(s)
-                    dim[2].dim = 3
-                    # replace data arrays [1,2,3] with [[[1,2,3]]]
-                    for k in range(dim[2].np):
-                        dim[2].p[k].data = [[dim[2].p[k].data]]
-                    for k in range(dim[2].nd):
-                        dim[2].d[k].data = [[dim[2].d[k].data]]
-                else:
-                    # append data arrays
-                    numP = min(s.np, len(dim[2].p))
-                    if (s.np > numP):
-                        print "First scan had %d positioners; This one only has %d." % (s.np, numP)
-                    for k in range(numP):
-                        if j==0: dim[2].p[k].data.append([])
-                        dim[2].p[k].data[i].append(s.p[k].data)
-                    numD = min(s.nd, len(dim[2].d))
-                    if (s.nd > numD):
-                        print "First scan had %d detectors; This one only has %d." % (s.nd, numD)
-                    for k in range(numD):
-                        if j==0: dim[2].d[k].data.append([])
-                        dim[2].d[k].data[i].append(s.d[k].data)
-        if use_numpy:
-            for p in dim[2].p:
-                p.data = numpy.array(p.data)
-            for d in dim[2].d:
-                d.data = numpy.array(d.data)
-
-    if ((rank > 3) and (maxdim > 3)):
-        # collect 4D data
-        for i in range(dim[0].curr_pt):
-            scanFile.seek(dim[0].plower_scans[i])
-            (s1, detToDat) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
-            for j in range(s1.curr_pt):
-                scanFile.seek(s1.plower_scans[j])
-                (s2, detToDat) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
-                for k in range(s2.curr_pt):
-                    scanFile.seek(s2.plower_scans[k])
-                    if (k==0) or not readQuick:
-                        (s, detToDat) = readScan(scanFile, max(0,verbose-1), out, unpacker=u)
-                    else:
-                        s = readScanQuick(scanFile, unpacker=u, detToDat_offset=detToDat)
-                    if ((i == 0) and (j == 0) and (k == 0)):
-                        dim.append(s)
-                        dim[3].dim = 4
-                        for m in range(dim[3].np):
-                            dim[3].p[m].data = [[[dim[3].p[m].data]]]
-                        for m in range(dim[3].nd):
-                            dim[3].d[m].data = [[[dim[3].d[m].data]]]
-                    else:
-                        # append data arrays
-                        if j==0 and k==0:
-                            for m in range(dim[3].np):
-                                dim[3].p[m].data.append([[]])
-                                dim[3].p[m].data[i][0].append(s.p[m].data)
-                            for m in range(dim[3].nd):
-                                dim[3].d[m].data.append([[]])
-                                dim[3].d[m].data[i][0].append(s.d[m].data)
-                        else:
-                            for m in range(dim[3].np):
-                                if k==0: dim[3].p[m].data[i].append([])
-                                dim[3].p[m].data[i][j].append(s.p[m].data)
-                            for m in range(dim[3].nd):
-                                if k==0: dim[3].d[m].data[i].append([])
-                                dim[3].d[m].data[i][j].append(s.d[m].data)
-        if use_numpy:
-            for p in dim[3].p:
-                p.data = numpy.array(p.data)
-            for d in dim[3].d:
-                d.data = numpy.array(d.data)
-
+                    (pData, dData) = index.rowData(dimNum, e, use_numpy)
+                    appendScanData(scan, coords[e], pData, dData)
+        mm.close()
 
+        if use_numpy:
+            for scan in dim[1:]:
+                for p in scan.p:
+                    p.data = numpy.array(p.data)
+                for d in scan.d:
+                    d.data = numpy.array(d.data)
 
     # Collect scan-environment variables into a dictionary
-    dict = {}
-    dict['sampleEntry'] = ("description", "unit string", "value", "EPICS_type", "count")
-    dict['filename'] = fname
-    dict['version'] = version
-    dict['scan_number'] = scan_number
-    dict['rank'] = rank
-    dict['dimensions'] = dimensions
-    acq_dimensions = []
-    for d in dim:
-        acq_dimensions.append(d.curr_pt)
-    dict['acquired_dimensions'] = acq_dimensions
-    dict['isRegular'] = isRegular
-    dict['ourKeys'] = ['sampleEntry', 'filename', 'version', 'scan_number', 'rank', 'dimensions', 'acquired_dimensions', 'isRegular', 'ourKeys']
-    if pExtra:
+    dict = makeHeaderDict(fname, version, scan_number, rank, dimensions, isRegular, dim)
+    if pExtra and env:
         scanFile.seek(pExtra)
         buf = scanFile.read()       # Read all scan-environment data
         u.reset(buf)
-        numExtra = u.unpack_int()
-        if verbose: out.write("\nnumber of 'Extra' PV's = %d\n" % numExtra)
-        for i in range(numExtra):
-            if verbose: out.write("env PV #%d -------\n" % (i))
-            name = ''
-            n = u.unpack_int()      # length of name string
-            if n: name = u.unpack_string()
-            if verbose: out.write("\tname = '%s'\n" % name)
-            desc = ''
-            n = u.unpack_int()      # length of desc string
-            if n: desc = u.unpack_string()
-            if verbose: out.write("\tdesc = '%s'\n" % desc)
-            EPICS_type = u.unpack_int()
-            if verbose: out.write("\tEPICS_type = %d (%s)\n" % (EPICS_type, EPICS_types(EPICS_type)))
-
-            unit = ''
-            value = ''
-            count = 0
-            if EPICS_type != 0:   # not DBR_STRING; array is permitted
-                count = u.unpack_int()  # 
-                if verbose: out.write("\tcount = %d\n" % count)
-                n = u.unpack_int()      # length of unit string
-                if n: unit = u.unpack_string()
-                if verbose: out.write("\tunit = '%s'\n" % unit)
-
-            if EPICS_type == 0: # DBR_STRING
-                n = u.unpack_int()      # length of value string
-                if n: value = u.unpack_string()
-            elif EPICS_type == 32: # DBR_CTRL_CHAR
-                #value = u.unpack_fstring(count)
-                vect = u.unpack_farray(count, u.unpack_int)
-                value = ""
-                for i in range(len(vect)):
-                    # treat the byte array as a null-terminated string
-                    if vect[i] == 0: break
-                    value = value + chr(vect[i])
-            elif EPICS_type == 29: # DBR_CTRL_SHORT
-                value = u.unpack_farray(count, u.unpack_int)
-            elif EPICS_type == 33: # DBR_CTRL_LONG
-                value = u.unpack_farray(count, u.unpack_int)
-            elif EPICS_type == 30: # DBR_CTRL_FLOAT
-                value = u.unpack_farray(count, u.unpack_float)
-            elif EPICS_type == 34: # DBR_CTRL_DOUBLE
-                value = u.unpack_farray(count, u.unpack_double)
-            if verbose:
-                if (EPICS_type == 0):
-                    out.write("\tvalue = '%s'\n" % (value))
-                else:
-                    out.write("\tvalue = ")
-                    verboseData(value, out)
-
-            dict[name] = (desc, unit, value, EPICS_type, count)
+        if env == 'lazy':
+            dict = lazyEnvDict(dict, buf, indexExtraPVs(u))
+        elif hasattr(env, '__iter__'):
+            readExtraPVs(u, dict, verbose, out, names=set(env))
+        else:
+            readExtraPVs(u, dict, verbose, out)
     scanFile.close()
 
     dim.reverse()
@@ -826,19 +1149,514 @@ def readMDA(fname=None, maxdim=4, verbose=0, showHelp=0, outFile=None, useNumpy=
         out.close()
     return dim
 
+def unpackFileHeader(u):
+    """usage: (version, scan_number, rank, dimensions, isRegular, pExtra) = unpackFileHeader(u)"""
+    version = u.unpack_float()
+    scan_number = u.unpack_int()
+    rank = u.unpack_int()
+    dimensions = u.unpack_farray(rank, u.unpack_int)
+    isRegular = u.unpack_int()
+    pExtra = u.unpack_int()
+    return (version, scan_number, rank, dimensions, isRegular, pExtra)
+
+# The file-level dictionary that readMDA() returns as dim[0] (without the
+# scan-environment PVs).
+def makeHeaderDict(fname, version, scan_number, rank, dimensions, isRegular, dim):
+    dict = {}
+    dict['sampleEntry'] = ("description", "unit string", "value", "EPICS_type", "count")
+    dict['filename'] = fname
+    dict['version'] = version
+    dict['scan_number'] = scan_number
+    dict['rank'] = rank
+    dict['dimensions'] = dimensions
+    dict['acquired_dimensions'] = [d.curr_pt for d in dim]
+    dict['isRegular'] = isRegular
+    dict['ourKeys'] = ['sampleEntry', 'filename', 'version', 'scan_number', 'rank', 'dimensions', 'acquired_dimensions', 'isRegular', 'ourKeys']
+    return dict
+
+# Scan headers (names, descriptions, ...) of each dimension come from the first
+# scan of that dimension.  u must hold the whole file (e.g., an mmap).
+def readFirstScanHeaders(u, offset, maxdim, verbose=0, out=sys.stdout):
+    dim = []
+    while len(dim) < maxdim:
+        u.set_position(offset)
+        header = readScanHeader(u, verbose, out)
+        if header == None:
+            print "* * * readFirstScanHeaders(offset=%d): rank > 20.  probably a corrupt file" % offset
+            break
+        s = header[0]
+        s.dim = len(dim) + 1
+        dim.append(s)
+        if (s.rank < 2) or (s.curr_pt < 1):
+            break
+        offset = s.plower_scans[0]
+    return dim
+
+def readMDAHeaders(fname, maxdim=4):
+    """usage: dim = readMDAHeaders(fname, maxdim=4)
+
+    Like readMDA(), but reads only the file header and the header (names,
+    descriptions, ...) of the first scan of each dimension: no data, and no
+    scan-environment PVs.  Reading stops at the first dimension without data.
+    As for skimMDA(), each header takes one bounded read (see skimHeader()),
+    the file header and the 1D scan header usually the same one.
+    Raises IOError if the file is not an MDA file.
+    """
+    file = open(fname, 'rb')
+    try:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise IOError("readMDAHeaders: %s is empty" % fname)
+        def parseFirst(u):
+            header = unpackFileHeader(u)
+            if abs(header[0] - 1.3) > .01:
+                return (header, None)   # not an MDA file: don't parse further
+            return (header, readScanHeader(u))
+        (header, found) = skimHeader(file, 0, parseFirst)
+        (version, scan_number, rank, dimensions, isRegular, pExtra) = header
+        if abs(version - 1.3) > .01:
+            raise IOError("readMDAHeaders: can't read MDA version %f.  Is %s really an MDA file?" % (version, fname))
+        dim = []
+        while (found != None) and (len(dim) < min(rank, maxdim)):
+            s = found[0]
+            s.dim = len(dim) + 1
+            dim.append(s)
+            if (s.rank < 2) or (s.curr_pt < 1) or (len(dim) == min(rank, maxdim)):
+                break
+            found = skimHeader(file, s.plower_scans[0], readScanHeader)
+    finally:
+        file.close()
+    return [makeHeaderDict(fname, version, scan_number, rank, dimensions, isRegular, dim)] + dim
+
+def readMDA_mmap(fname, maxdim=4, verbose=0, out=sys.stdout, readQuick=True):
+    """usage: readMDA_mmap(fname, maxdim=4, verbose=0, out=sys.stdout, readQuick=True)
+
+    The result structure of readMDA(fname, maxdim, useNumpy=True), but
+    with much lower peak memory for multi-dimensional files.  The file is
+    memory-mapped, the plower_scans offset tables are followed in one pass
+    (see MdaIndex), and each data block is copied (and byteswapped) from the
+    map directly into numpy arrays allocated once per dimension:
+
+        dim[1] data: (npts_1,)
+        dim[2] data: (curr_pt_1, npts_2)
+        dim[3] data: (curr_pt_1, npts_2, npts_3)
+        dim[4] data: (curr_pt_1, npts_2, npts_3, npts_4)
+
+    Points of incomplete inner scans that were never acquired are left as zero.
+    Inner dimensions have their planned npts, so the array shapes differ from
+    readMDA() when an inner dimension was only partly acquired (e.g. (2,7,26)
+    here, (2,5,26) from readMDA()).
+    Positioners are float64, detectors float32 (as stored in the file).
+
+    readQuick is as for readMDA(), but on by default: the inner scans are
+    located from the header size of the first and last scan of each
+    dimension, and any scan whose header does not fit is parsed completely.
+    """
+    global use_numpy
+
+    if not have_numpy:
+        print "readMDA_mmap: requires the python 'numpy' package, but we can't import it."
+        return None
+    if (not os.path.isfile(fname)):
+        if (not fname.endswith('.mda')):
+            fname = fname + '.mda'
+        if (not os.path.isfile(fname)):
+            print fname, "not found"
+            return None
+    use_numpy = True
+
+    scanFile = open(fname, 'rb')
+    if os.fstat(scanFile.fileno()).st_size == 0:
+        print fname, "is empty"
+        scanFile.close()
+        return None
+    buf = mmap.mmap(scanFile.fileno(), 0, access=mmap.ACCESS_READ)
+    u = xdr.Unpacker(buf)
+
+    # read file header
+    (version, scan_number, rank, dimensions, isRegular, pExtra) = unpackFileHeader(u)
+    if abs(version - 1.3) > .01:
+        print "I can't read MDA version %f.  Is this really an MDA file?" % version
+        buf.close()
+        scanFile.close()
+        return None
+    pmain_scan = u.get_position()
+
+    dim = readFirstScanHeaders(u, pmain_scan, min(rank, maxdim), max(0,verbose-1), out)
+
+    # allocate the arrays for each dimension, then fill them in one traversal
+    arrays = []
+    shape = ()
+    for k in range(len(dim)):
+        s = dim[k]
+        if k == 1:
+            shape = (dim[0].curr_pt,)
+        elif k > 1:
+            shape = shape + (dim[k-1].npts,)
+        pData = numpy.zeros((s.np,) + shape + (s.npts,), dtype='=f8')
+        dData = numpy.zeros((s.nd,) + shape + (s.npts,), dtype='=f4')
+        for j in range(s.np):
+            s.p[j].data = pData[j]
+        for j in range(s.nd):
+            s.d[j].data = dData[j]
+        arrays.append((pData, dData))
+
+    index = MdaIndex(u, pmain_scan, len(dim), readQuick)
+    for k in range(index.rank):
+        (pData, dData) = arrays[k]
+        coords = index.coordinates(k+1)
+        for e in range(len(coords)):
+            coord = coords[e]
+            if [i for i in range(len(coord)) if coord[i] >= pData.shape[i+1]]:
+                continue    # scan beyond the shape of the first scan
+            (npts, np, nd) = (index.npts[k][e], index.np[k][e], index.nd[k][e])
+            n = min(npts, pData.shape[-1])
+            if min(np, pData.shape[0]):
+                block = numpy.frombuffer(buf, dtype='>f8', count=np*npts, offset=index.dataOffset[k][e])
+                block = block.reshape(np, npts)[:pData.shape[0], :n]
+                pData[(slice(0, len(block)),) + coord + (slice(0, n),)] = block
+            if min(nd, dData.shape[0]):
+                block = numpy.frombuffer(buf, dtype='>f4', count=nd*npts, offset=index.dataOffset[k][e]+8*np*npts)
+                block = block.reshape(nd, npts)[:dData.shape[0], :n]
+                dData[(slice(0, len(block)),) + coord + (slice(0, n),)] = block
+
+    dict = makeHeaderDict(fname, version, scan_number, rank, dimensions, isRegular, dim)
+    if pExtra:
+        u.set_position(pExtra)
+        readExtraPVs(u, dict, verbose, out)
+    buf.close()
+    scanFile.close()
+
+    return [dict] + dim
+
+################################################################################
+# lazy (on-demand) access to an MDA file
+
+# Positioner and detector descriptions of an MdaFile.  The 'data' attribute is
+# not stored here; it is decoded by (and cached in) the MdaFile on first use.
+class lazyScanPositioner(scanPositioner, object):
+    def __init__(self, mdaFile, dimNum, index, header):
+        for k, v in header.__dict__.items():
+            if k != 'data':
+                setattr(self, k, v)
+        self.mdaFile = mdaFile
+        self.dimNum = dimNum
+        self.index = index
+
+    def getData(self):
+        return self.mdaFile.positionerData(self.dimNum, self.index)
+
+    def setData(self, data):
+        self.mdaFile.cache[(self.dimNum, 'p', self.index)] = data
+
+    data = property(getData, setData)
+
+class lazyScanDetector(scanDetector, object):
+    def __init__(self, mdaFile, dimNum, index, header):
+        for k, v in header.__dict__.items():
+            if k != 'data':
+                setattr(self, k, v)
+        self.mdaFile = mdaFile
+        self.dimNum = dimNum
+        self.index = index
+
+    def getData(self):
+        return self.mdaFile.detectorData(self.dimNum, self.index)
+
+    def setData(self, data):
+        self.mdaFile.cache[(self.dimNum, 'd', self.index)] = data
+
+    data = property(getData, setData)
+
+class MdaFile:
+    """
+    usage: f = MdaFile(fname, maxdim=4, useNumpy=None)
+
+    Lazy access to an MDA file, indexed like the list returned by readMDA():
+
+        f[0]             -> dictionary of file info and scan-environment PVs
+        f[1].p[0].name   -> name of positioner 1 of the 1D scan
+        f[2].d[7].data   -> 2D array of detector 7 data
+
+    Only the file header, the scan-environment PVs, and the header of the
+    first scan of each dimension are read when the object is created.  The
+    data of a positioner or detector (one dimension at a time) is decoded the
+    first time its 'data' attribute is used and then cached on this object.
+    The file stays open (memory-mapped) until close() is called.
+
+    Raises IOError if the file cannot be opened or is not an MDA file.
+    """
+    def __init__(self, fname, maxdim=4, useNumpy=None):
+        global use_numpy
+
+        if useNumpy and not have_numpy:
+            raise ImportError("MdaFile: Caller requires that we use the python 'numpy' package, but we can't import it.")
+        use_numpy = useNumpy
+        self.useNumpy = useNumpy
+        self.filename = fname
+        self.cache = {}    # (dimNum, 'p' or 'd', index): data
+        self.index = None  # MdaIndex, built when the first data are decoded
+
+        self.file = open(fname, 'rb')
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.file.close()
+            raise IOError("MdaFile: %s is empty" % fname)
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.u = xdr.Unpacker(self.buf)
+
+        (version, scan_number, rank, dimensions, isRegular, pExtra) = unpackFileHeader(self.u)
+        if abs(version - 1.3) > .01:
+            self.close()
+            raise IOError("MdaFile: can't read MDA version %f.  Is %s really an MDA file?" % (version, fname))
+        self.pmain_scan = self.u.get_position()
+
+        dim = readFirstScanHeaders(self.u, self.pmain_scan, min(rank, maxdim))
+        for s in dim:
+            s.p = [lazyScanPositioner(self, s.dim, j, s.p[j]) for j in range(s.np)]
+            s.d = [lazyScanDetector(self, s.dim, j, s.d[j]) for j in range(s.nd)]
+
+        dict = makeHeaderDict(fname, version, scan_number, rank, dimensions, isRegular, dim)
+        if pExtra:
+            self.u.set_position(pExtra)
+            readExtraPVs(self.u, dict)
+        self.dim = [dict] + dim
+
+    def __len__(self):
+        return len(self.dim)
+
+    def __getitem__(self, i):
+        return self.dim[i]
+
+    def __iter__(self):
+        return iter(self.dim)
+
+    def close(self):
+        """release the file; data not yet decoded can no longer be read"""
+        self.buf.close()
+        self.file.close()
+
+    def getIndex(self):
+        """MdaIndex of all scans in the file, built on first request"""
+        if self.index == None:
+            self.index = MdaIndex(self.u, self.pmain_scan, len(self.dim)-1)
+        return self.index
+
+    def positionerData(self, dimNum, index):
+        """data of positioner dim[dimNum].p[index], decoded on first request"""
+        return self.decode(dimNum, 'p', index)
+
+    def detectorData(self, dimNum, index):
+        """data of detector dim[dimNum].d[index], decoded on first request"""
+        return self.decode(dimNum, 'd', index)
+
+    def decode(self, dimNum, part, index):
+        key = (dimNum, part, index)
+        if key not in self.cache:
+            data = []
+            mdaIndex = self.getIndex()
+            k = dimNum-1
+            coords = mdaIndex.coordinates(dimNum)
+            for e in range(len(coords)):
+                (npts, np, nd) = (mdaIndex.npts[k][e], mdaIndex.np[k][e], mdaIndex.nd[k][e])
+                if part == 'p':
+                    if index >= np: continue
+                    offset = mdaIndex.dataOffset[k][e] + 8*npts*index
+                else:
+                    if index >= nd: continue
+                    offset = mdaIndex.dataOffset[k][e] + 8*npts*np + 4*npts*index
+                row = self.unpackRow(part, offset, npts)
+                if dimNum == 1:
+                    data = row
+                else:
+                    appendNested(data, coords[e], row)
+            if self.useNumpy:
+                data = numpy.array(data, dtype={'p': '=f8', 'd': '=f4'}[part])
+            self.cache[key] = data
+        return self.cache[key]
+
+    def unpackRow(self, part, offset, npts):
+        if self.useNumpy:
+            dtype = {'p': '>f8', 'd': '>f4'}[part]
+            return numpy.frombuffer(self.buf, dtype=dtype, count=npts, offset=offset)
+        u = self.u
+        u.set_position(offset)
+        if part == 'p':
+            if have_fast_xdr:
+                return u.unpack_farray_double(npts)
+            return u.unpack_farray(npts, u.unpack_double)
+        if have_fast_xdr:
+            return u.unpack_farray_float(npts)
+        return u.unpack_farray(npts, u.unpack_float)
+
+################################################################################
+# follow an MDA file while it is being written
+class MdaFollower:
+    """
+    usage: f = MdaFollower(fname, maxdim=4)
+           if f.poll(): data = f.dim
+
+    Follow an MDA file while the sscan record is still acquiring (saveData
+    rewrites the header of the outer scan after each of its points).  The file
+    stays open.  poll() returns True if there are new data.  It re-reads the
+    outer scan (header and data) and decodes only the inner scans completed
+    since the last poll, following plower_scans, so a refresh costs O(new rows)
+    instead of O(whole file).
+
+    f.dim is built like the list from readMDA() (data in lists, not numpy
+    arrays); f.rows is the number of completed points of the outer scan.  A
+    file caught in the middle of being written is tried again at the next
+    poll.  If the file shrinks (e.g., was replaced), it is read from the start.
+    """
+    def __init__(self, fname, maxdim=4):
+        self.filename = fname
+        self.maxdim = maxdim
+        self.file = open(fname, 'rb')
+        self.state = None   # (size, mtime) at the last successful poll
+        self.size = 0
+        self.reset()
+
+    def reset(self):
+        self.rows = 0       # outer points whose inner scans have been read
+        self.inner = []     # first scan of each inner dimension, with the data so far
+        self.env = {}       # scan-environment PVs
+        self.pExtra = 0
+        self.dim = []
+
+    def close(self):
+        self.file.close()
+
+    def poll(self):
+        """read new data, if any; returns True if self.dim changed"""
+        st = os.fstat(self.file.fileno())
+        if (st.st_size, st.st_mtime) == self.state or st.st_size == 0:
+            return False
+        if st.st_size < self.size:
+            self.reset()
+        buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                changed = self.update(xdr.Unpacker(buf))
+            except (EOFError, ValueError, IndexError, struct.error):
+                return False    # caught while being written, try again next time
+        finally:
+            buf.close()
+        self.state = (st.st_size, st.st_mtime)
+        self.size = st.st_size
+        return changed
+
+    def update(self, u):
+        (version, scan_number, rank, dimensions, isRegular, pExtra) = unpackFileHeader(u)
+        if abs(version - 1.3) > .01:
+            raise IOError("MdaFollower: can't read MDA version %f.  Is %s really an MDA file?" % (version, self.filename))
+        header = readScanHeader(u)
+        if header == None:
+            return False
+        (outer, detPosition, dataPosition) = header
+        outer.dim = 1
+        (pData, dData) = unpackScanData(u.get_buffer(), dataPosition, outer.npts, outer.np, outer.nd)
+        for j in range(outer.np):
+            outer.p[j].data = pData[j]
+        for j in range(outer.nd):
+            outer.d[j].data = dData[j]
+
+        env = self.env
+        if pExtra and (pExtra != self.pExtra):
+            try:
+                env = {}
+                u.set_position(pExtra)
+                readExtraPVs(u, env)
+            except (EOFError, ValueError, struct.error):
+                (env, pExtra) = (self.env, self.pExtra)     # not written yet, try again next time
+
+        # inner scans of new outer points: index just their subtrees
+        rows = self.rows
+        newRows = []
+        if (rank > 1) and (self.maxdim > 1):
+            for i in range(self.rows, min(outer.curr_pt, outer.npts)):
+                index = MdaIndex(u, outer.plower_scans[i], min(rank, self.maxdim)-1)
+                if not self.isComplete(index, len(u.get_buffer())):
+                    break
+                newRows.append(index)
+        else:
+            rows = min(outer.curr_pt, outer.npts)
+
+        # nothing can fail from here on
+        for index in newRows:
+            self.appendRow(rows, index)
+            rows += 1
+        self.rows = rows
+        self.env = env
+        self.pExtra = pExtra
+
+        dim = [outer] + self.inner
+        dict = makeHeaderDict(self.filename, version, scan_number, rank, dimensions, isRegular, dim)
+        dict.update(self.env)
+        self.dim = [dict] + dim
+        return True
+
+    def isComplete(self, index, size):
+        """True if all the data blocks of the indexed scans are in the file"""
+        for k in range(index.rank):
+            for e in range(index.entries(k+1)):
+                end = index.dataOffset[k][e] + index.npts[k][e]*(8*index.np[k][e] + 4*index.nd[k][e])
+                if (index.dataOffset[k][e] == 0) or (end > size):
+                    return False
+        return True
+
+    def appendRow(self, row, index):
+        """append the inner scans of outer point 'row' (indexed by 'index')"""
+        for dimNum in range(1, index.rank+1):
+            coords = index.coordinates(dimNum)
+            for e in range(len(coords)):
+                coord = (row,) + coords[e]
+                if len(self.inner) < dimNum:
+                    scan = index.readRow(coords[e])
+                    scan.dim = dimNum + 1
+                    self.inner.append(scan)
+                    # replace data arrays [1,2,3] with [[1,2,3]], [[[1,2,3]]], ...
+                    for p in scan.p + scan.d:
+                        data = p.data
+                        p.data = []
+                        appendNested(p.data, coord, data)
+                else:
+                    (pData, dData) = index.rowData(dimNum, e)
+                    appendScanData(self.inner[dimNum-1], coord, pData, dData)
+
 ################################################################################
 # skim MDA file to get dimensions (planned and actually acquired), and other info
-def skimScan(dataFile):
-    """usage: skimScan(dataFile)"""
+#
+# Only the file header and the first scan header of each dimension are read,
+# a few bounded reads per file (the data blocks are never read).
+skimReadSize = 4096    # bytes read at once, more only for a longer header
+
+def skimHeader(dataFile, offset, parse, size=None):
+    """usage: result = skimHeader(dataFile, offset, parse, size=None)
+
+    Read the bytes at file offset 'offset' and return parse(u), where u is an
+    unpacker of those bytes.  If the header parsed is longer than the bytes
+    read, it is read again with twice as many bytes.
+    """
+    size = size or skimReadSize
+    while True:
+        dataFile.seek(offset)
+        buf = dataFile.read(size)
+        try:
+            return parse(xdr.Unpacker(buf))
+        except (EOFError, struct.error):
+            if len(buf) < size:
+                raise    # the file ends within the header
+            size *= 2
+
+def unpackSkimScan(u, fname=''):
+    """usage: scan = unpackSkimScan(u, fname='')
+
+    The header fields of the scan at the current position of unpacker u that
+    skimMDA() returns (no descriptions).  None if the scan has no data.
+    """
     scan = scanDim()    # data structure to hold scan info and data
-    buf = dataFile.read(10000) # enough to read scan header
-    u = xdr.Unpacker(buf)
-    scan.rank = u.unpack_int()
+    unpackScanFields(u, scan, scanStartFields)
     if (scan.rank > 20) or (scan.rank < 0):
-        print "* * * skimScan('%s'): rank > 20.  probably a corrupt file" % dataFile.name
+        print "* * * skimScan('%s'): rank > 20.  probably a corrupt file" % fname
         return None
-    scan.npts = u.unpack_int()
-    scan.curr_pt = u.unpack_int()
     if (scan.curr_pt == 0):
         #print "mda:skimScan: curr_pt = 0"
         return None
@@ -851,11 +1669,13 @@ def skimScan(dataFile):
     scan.name = u.unpack_string()
     timelength = u.unpack_int()
     scan.time = u.unpack_string()
-    scan.np = u.unpack_int()
-    scan.nd = u.unpack_int()
-    scan.nt = u.unpack_int()
+    unpackScanFields(u, scan, scanCountFields)
     return scan
 
+def skimScan(dataFile):
+    """usage: skimScan(dataFile)"""
+    return skimHeader(dataFile, dataFile.tell(), lambda u: unpackSkimScan(u, dataFile.name))
+
 def skimMDA(fname=None, verbose=False):
     """usage skimMDA(fname=None)"""
     #print "skimMDA: filename=", fname
@@ -876,59 +1696,30 @@ def skimMDA(fname=None, verbose=False):
         print "mda_f:skimMDA: failed to open file '%s'" % fname
         return None
 
-    buf = dataFile.read(100)        # to read header for scan of up to 5 dimensions
-    u = xdr.Unpacker(buf)
-
-    # read file header
-    version = u.unpack_float()
-#    if version < 1.299 or version > 1.301:
-#        print fname, " has file version", version
-#        return None
-    scan_number = u.unpack_int()
-    rank = u.unpack_int()
-    dimensions = u.unpack_farray(rank, u.unpack_int)
-    isRegular = u.unpack_int()
-    pExtra = u.unpack_int()
-    pmain_scan = dataFile.tell() - (len(buf) - u.get_position())
-
-    # collect 1D data
-    dataFile.seek(pmain_scan)
-    scan = skimScan(dataFile)
-    if (scan == None):
-        if verbose: print fname, "contains no data"
-        return None
-
-    dim.append(scan)
-    dim[0].dim = 1
-
-    if (rank > 1):
-        dataFile.seek(dim[0].plower_scans[0])
-        dim.append(skimScan(dataFile))
-        if (dim[1]):
-            dim[1].dim = 2
-        else:
-            if verbose: print "had a problem reading 2d from ", fname
-            return None
-
-    if (rank > 2):
-        dataFile.seek(dim[1].plower_scans[0])
-        dim.append(skimScan(dataFile))
-        if (dim[2]):
-            dim[2].dim = 3
-        else:
-            if verbose: print "had a problem reading 3d from ", fname
-            return None
-
-    if (rank > 3):
-        dataFile.seek(dim[2].plower_scans[0])
-        dim.append(skimScan(dataFile))
-        if (dim[3]):
-            dim[3].dim = 4
-        else:
-            if verbose: print "had a problem reading 4d from ", fname
+    try:
+        # file header and 1D scan header, usually in the same read
+        def parseFirst(u):
+            return (unpackFileHeader(u), unpackSkimScan(u, fname))
+        (header, scan) = skimHeader(dataFile, 0, parseFirst)
+        (version, scan_number, rank, dimensions, isRegular, pExtra) = header
+        if (scan == None):
+            if verbose: print fname, "contains no data"
             return None
+        scan.dim = 1
+        dim.append(scan)
+
+        # first scan of each inner dimension
+        for dimNum in range(2, min(rank, 4)+1):
+            scan = skimHeader(dataFile, dim[-1].plower_scans[0],
+                              lambda u: unpackSkimScan(u, fname))
+            if (scan == None):
+                if verbose: print "had a problem reading %dd from " % dimNum, fname
+                return None
+            scan.dim = dimNum
+            dim.append(scan)
+    finally:
+        dataFile.close()
 
-    dataFile.close()
     dict = {}
     dict['filename'] = fname
     dict['version'] = version
@@ -945,6 +1736,39 @@ def skimMDA(fname=None, verbose=False):
     dim.reverse()
     return dim
 
+def skimMDAList(fnames, threads=8, skim=None):
+    """usage: dimList = skimMDAList(fnames, threads=8, skim=None)
+
+    skimMDA() of each file, several files read at once by a pool of threads
+    (skimming is mostly waiting for the file system).  The results are in the
+    same order as fnames; None for a file that could not be read.  Another
+    function of the file name (such as readMDAHeaders) may be given as skim.
+    """
+    import threading
+    skim = skim or skimMDA
+    def skimOne(fname):
+        try:
+            return skim(fname)
+        except Exception:
+            return None
+    fnames = list(fnames)
+    if (threads < 2) or (len(fnames) < 2):
+        return map(skimOne, fnames)
+    results = [None] * len(fnames)
+    todo = iter(range(len(fnames)))
+    lock = threading.Lock()
+    def skimSome():
+        while True:
+            with lock:
+                i = next(todo, None)
+            if i == None:
+                return
+            results[i] = skimOne(fnames[i])
+    workers = [threading.Thread(target=skimSome) for i in range(min(threads, len(fnames)))]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    return results
+
 ################################################################################
 # Write MDA file
 def packScanHead(scan):
@@ -1020,189 +1844,205 @@ def packScanHead(scan):
     s.bufLen = len(s.preamble) + len(s.pLowerScansBuf) + len(s.postamble)
     return s
 
+# XDR bytes of the n values in list or numpy array 'values', packed all at
+# once (code 'd': double, 'f': float, 'l': int)
+numpyXdrTypes = {'d': '>f8', 'f': '>f4', 'l': '>i4'}
+def packArray(values, n, code):
+    if have_numpy and isinstance(values, numpy.ndarray):
+        if values.shape != (n,):
+            raise ValueError, 'wrong array size'
+        return values.astype(numpyXdrTypes[code]).tostring()
+    if len(values) != n:
+        raise ValueError, 'wrong array size'
+    return struct.pack('>%d%s' % (n, code), *values)
+
+# the data array of the scan at N-D coordinate cpt (one index per outer dimension)
+def scanRow(data, cpt):
+    for j in cpt:
+        data = data[j]
+    return data
+
 def packScanData(scan, cpt):
+    data = []
+    for i in range(scan.np):
+        data.append(packArray(scanRow(scan.p[i].data, cpt), scan.npts, 'd'))
+    for i in range(scan.nd):
+        data.append(packArray(scanRow(scan.d[i].data, cpt), scan.npts, 'f'))
+    return ''.join(data)
+
+# number of scans of dimension dimNum+1 within the scan of dimension dimNum at
+# coordinate cpt: as many as there are data arrays (only the acquired scans)
+def innerScanCount(dim, dimNum, cpt):
+    outer = dim[dimNum]
+    inner = dim[dimNum+1]
+    arrays = inner.p + inner.d
+    if len(arrays) == 0:
+        return min(outer.curr_pt, outer.npts)
+    return min(len(scanRow(arrays[0].data, cpt)), outer.npts)
+
+# scan-environment section from the dictionary dim[0]
+def packExtraPVs(dict):
     p = xdr.Packer()
-    if (len(cpt) == 0): # 1D array
-        for i in range(scan.np):
-            p.pack_farray(scan.npts, scan.p[i].data, p.pack_double)    
-        for i in range(scan.nd):
-            p.pack_farray(scan.npts, scan.d[i].data, p.pack_float)
-    
-    elif (len(cpt) == 1): # 2D array
-        j = cpt[0]
-        for i in range(scan.np):
-            p.pack_farray(scan.npts, scan.p[i].data[j], p.pack_double)    
-        for i in range(scan.nd):
-            p.pack_farray(scan.npts, scan.d[i].data[j], p.pack_float)
-
-    elif (len(cpt) == 2): # 3D array
-        j = cpt[0]
-        k = cpt[1]
-        for i in range(scan.np):
-            p.pack_farray(scan.npts, scan.p[i].data[j][k], p.pack_double)    
-        for i in range(scan.nd):
-            p.pack_farray(scan.npts, scan.d[i].data[j][k], p.pack_float)
-
-    return(p.get_buffer())
+    # Note we don't want to write the dict entries we made for our own
+    # use in the scanDim object.
+    names = [name for name in dict.keys() if not (name in dict['ourKeys'])]
+    p.pack_int(len(names))
+
+    for name in names:
+        (desc, unit, value, EPICS_type, count) = dict[name][:5]
+        n = len(name); p.pack_int(n)
+        if (n): p.pack_string(name)
+        n = len(desc); p.pack_int(n)
+        if (n): p.pack_string(desc)
+        p.pack_int(EPICS_type)
+        if EPICS_type != 0:   # not DBR_STRING, so pack count and units
+            p.pack_int(count)
+            n = len(unit); p.pack_int(n)
+            if (n): p.pack_string(unit)
+        if EPICS_type == 0: # DBR_STRING
+            n = len(value); p.pack_int(n)
+            if (n): p.pack_string(value)
+        elif EPICS_type == 32: # DBR_CTRL_CHAR
+            # write null-terminated string, padded with nulls to count
+            v = (map(ord, value) + [0]*count)[:count]
+            p.pack_fstring(4*count, packArray(v, count, 'l'))
+        elif EPICS_type in (29, 33): # DBR_CTRL_SHORT, DBR_CTRL_LONG
+            p.pack_fstring(4*count, packArray(value, count, 'l'))
+        elif EPICS_type == 30: # DBR_CTRL_FLOAT
+            p.pack_fstring(4*count, packArray(value, count, 'f'))
+        elif EPICS_type == 34: # DBR_CTRL_DOUBLE
+            p.pack_fstring(8*count, packArray(value, count, 'd'))
+    return p.get_buffer()
+
+# bytes of one scan of each dimension of dim (header and data, without the
+# inner scans); sizes[0] is not used
+def scanSizes(dim, heads):
+    sizes = [0]
+    for dimNum in range(1, len(heads)):
+        scan = dim[dimNum]
+        sizes.append(heads[dimNum].bufLen + scan.npts * (scan.np * 8 + scan.nd * 4))
+    return sizes
+
+def layoutMDA(dim, sizes, offset):
+    """usage: (scans, end) = layoutMDA(dim, sizes, offset)
+
+    Byte layout of the scans of dim (as from readMDA()) in an MDA file, for any
+    rank: the first scan starts at file offset 'offset' and each scan of
+    dimension k takes sizes[k] bytes, followed by its inner scans.  Returns the
+    list of (dimNum, cpt, offset, innerOffsets) of each scan, in file order, and
+    the offset after the last scan.  cpt is the N-D coordinate of the scan.
+    """
+    numDims = len(sizes) - 1
+    scans = []
+    def place(dimNum, cpt, offset):
+        inner = []
+        scans.append((dimNum, cpt, offset, inner))
+        offset = offset + sizes[dimNum]
+        if (dimNum < numDims):
+            for i in range(innerScanCount(dim, dimNum, cpt)):
+                inner.append(offset)
+                offset = place(dimNum+1, cpt + (i,), offset)
+        return offset
+    end = place(1, (), offset)
+    return (scans, end)
+
+writeBufferSize = 1 << 20    # bytes collected before each write to the file
 
 def writeMDA(dim, fname=None):
-    m = mdaBuf()
-    p = xdr.Packer()
+    """usage: writeMDA(dim, fname=None)
 
-    p.reset()
+    Write the scan dim (as from readMDA()) to MDA file fname.  The file layout
+    (the offset of every scan, see layoutMDA()) is computed first; then each
+    scan is packed, whole arrays at a time, and written.  Only the scans with
+    data in dim are written: the offsets of scans not acquired are 0.
+    """
     if (type(dim) != type([])): print "writeMDA: first arg must be a scan"
     if ((fname != None) and (type(fname) != type(""))):
         print "writeMDA: second arg must be a filename or None"
     rank = dim[0]['rank']    # rank of scan as a whole
+    numDims = min(rank, len(dim)-1)    # dimensions with data
+
     # write file header
+    p = xdr.Packer()
     p.pack_float(dim[0]['version'])
     p.pack_int(dim[0]['scan_number'])
     p.pack_int(dim[0]['rank'])
     p.pack_farray(rank, dim[0]['dimensions'], p.pack_int)
     p.pack_int(dim[0]['isRegular'])
-    m.header = p.get_buffer()
+    header = p.get_buffer()
 
-    p.reset()
-    p.pack_int(0) # pExtra
-    m.pExtra = p.get_buffer()
-
-    m.scan = packScanHead(dim[1])
-    m.scan.offset = len(m.header) + len(m.pExtra)
-    m.scan.data = packScanData(dim[1], [])
-    m.scan.bufLen = m.scan.bufLen + len(m.scan.data)
-    prevScan = m.scan
-    #print "\n m.scan=", m.scan
-    #print "\n type(m.scan.pLowerScans)=", type(m.scan.pLowerScans)
-
-    if (rank > 1):
-        for i in range(m.scan.npts):
-            m.scan.inner.append(packScanHead(dim[2]))
-            thisScan = m.scan.inner[i]
-            thisScan.offset = prevScan.offset + prevScan.bufLen
-            m.scan.pLowerScans.append(thisScan.offset)
-            thisScan.data = packScanData(dim[2], [i])
-            thisScan.bufLen = thisScan.bufLen + len(thisScan.data)
-            prevScan = thisScan
-
-            if (rank > 2):
-                for j in range(m.scan.inner[i].npts):
-                    m.scan.inner[i].inner.append(packScanHead(dim[3]))
-                    thisScan = m.scan.inner[i].inner[j]
-                    thisScan.offset = prevScan.offset + prevScan.bufLen
-                    m.scan.inner[i].pLowerScans.append(thisScan.offset)
-                    thisScan.data = packScanData(dim[3], [i,j])
-                    thisScan.bufLen = thisScan.bufLen + len(thisScan.data)
-                    prevScan = thisScan
-
-                if (rank > 3):
-                    for k in range(m.scan.inner[i].inner[j].npts):
-                        m.scan.inner[i].inner[j].append(packScanHead(dim[4]))
-                        thisScan = m.scan.inner[i].inner[j].inner[k]
-                        thisScan.offset = prevScan.offset + prevScan.bufLen
-                        m.scan.inner[i].inner[j].pLowerScans.append(thisScan.offset)
-                        thisScan.data = packScanData(dim[4], [i,j,k])
-                        thisScan.bufLen = thisScan.bufLen + len(thisScan.data)
-                        prevScan = thisScan
-
-    # Now we know where the extraPV section must go.
-    p.reset()
-    p.pack_int(prevScan.offset + prevScan.bufLen) # pExtra
-    m.pExtra = p.get_buffer()
-
-    # pack scan-environment variables from dictionary
-    p.reset()
-
-    numKeys = 0
-    for name in dim[0].keys():
-        if not (name in dim[0]['ourKeys']):
-            numKeys = numKeys + 1
-    p.pack_int(numKeys)
-
-    for name in dim[0].keys():
-        # Note we don't want to write the dict entries we made for our own
-        # use in the scanDim object.
-        if not (name in dim[0]['ourKeys']):
-            desc = dim[0][name][0]
-            unit = dim[0][name][1]
-            value = dim[0][name][2]
-            EPICS_type = dim[0][name][3]
-            count = dim[0][name][4]
-            n = len(name); p.pack_int(n)
-            if (n): p.pack_string(name)
-            n = len(desc); p.pack_int(n)
-            if (n): p.pack_string(desc)
-            p.pack_int(EPICS_type)
-            if EPICS_type != 0:   # not DBR_STRING, so pack count and units
-                p.pack_int(count)
-                n = len(unit); p.pack_int(n)
-                if (n): p.pack_string(unit)
-            if EPICS_type == 0: # DBR_STRING
-                n = len(value); p.pack_int(n)
-                if (n): p.pack_string(value)
-            elif EPICS_type == 32: # DBR_CTRL_CHAR
-                # write null-terminated string
-                v = []
-                for i in range(len(value)): v.append(ord(value[i:i+1]))
-                v.append(0)
-                p.pack_farray(count, v, p.pack_int)
-            elif EPICS_type == 29: # DBR_CTRL_SHORT
-                p.pack_farray(count, value, p.pack_int)
-            elif EPICS_type == 33: # DBR_CTRL_LONG
-                p.pack_farray(count, value, p.pack_int)
-            elif EPICS_type == 30: # DBR_CTRL_FLOAT
-                p.pack_farray(count, value, p.pack_float)
-            elif EPICS_type == 34: # DBR_CTRL_DOUBLE
-                p.pack_farray(count, value, p.pack_double)
-
-    m.extraPV = p.get_buffer()
-
-    # Now we have to repack all the scan offsets
-    if (rank > 1): # 2D scan
-        #print "m.scan.pLowerScans", m.scan.pLowerScans
-        p.reset()
-        p.pack_farray(m.scan.npts, m.scan.pLowerScans, p.pack_int)
-        m.scan.pLowerScansBuf = p.get_buffer()
-        if (rank > 2): # 3D scan
-            for i in range(m.scan.npts):
-                p.reset()
-                p.pack_farray(m.scan.inner[i].npts, m.scan.inner[i].pLowerScans, p.pack_int)
-                m.scan.inner[i].pLowerScansBuf = p.get_buffer()
-                if (rank > 3): # 4D scan
-                    for j in range(m.scan.inner[i].npts):
-                        p.reset()
-                        p.pack_farray(m.scan.inner[i].inner[j].npts, m.scan.inner[i].inner[j].pLowerScans, p.pack_int)
-                        m.scan.inner[i].inner[j].pLowerScansBuf = p.get_buffer()
+    # All scans of one dimension have the same header (but for the offsets
+    # of their inner scans) and the same size.
+    heads = [None] + [packScanHead(dim[dimNum]) for dimNum in range(1, numDims+1)]
+    (scans, pExtra) = layoutMDA(dim, scanSizes(dim, heads), len(header) + 4)
 
     # Write
     if (fname == None): fname = tkFileDialog.SaveAs().show()
     f = open(fname, 'wb')
-
-    f.write(m.header)
-    f.write(m.pExtra)
-    s0 = m.scan
-    f.write(s0.preamble)
-    if len(s0.pLowerScansBuf): f.write(s0.pLowerScansBuf)
-    f.write(s0.postamble)
-    f.write(s0.data)
-    for s1 in s0.inner:
-        f.write(s1.preamble)
-        if len(s1.pLowerScansBuf): f.write(s1.pLowerScansBuf)
-        f.write(s1.postamble)
-        f.write(s1.data)
-        for s2 in s1.inner:
-            f.write(s2.preamble)
-            if len(s2.pLowerScansBuf): f.write(s2.pLowerScansBuf)
-            f.write(s2.postamble)
-            f.write(s2.data)
-            for s3 in s2.inner:
-                f.write(s3.preamble)
-                if len(s3.pLowerScansBuf): f.write(s3.pLowerScansBuf)
-                f.write(s3.postamble)
-                f.write(s3.data)
-    f.write(m.extraPV)
-    f.close()
+    try:
+        buf = [header, packArray([pExtra], 1, 'l')]
+        bufLen = 0
+        for (dimNum, cpt, offset, inner) in scans:
+            scan = dim[dimNum]
+            buf.append(heads[dimNum].preamble)
+            if (scan.rank > 1):
+                inner = inner + [0] * (scan.npts - len(inner))
+                buf.append(packArray(inner, scan.npts, 'l'))
+            buf.append(heads[dimNum].postamble)
+            data = packScanData(scan, cpt)
+            buf.append(data)
+            bufLen = bufLen + len(data)
+            if (bufLen >= writeBufferSize):
+                f.write(''.join(buf))
+                buf = []
+                bufLen = 0
+        buf.append(packExtraPVs(dim[0]))
+        f.write(''.join(buf))
+    finally:
+        f.close()
     return
 
+def roundTripMDA(fname, tempName=None, repeat=3, useNumpy=False):
+    """usage: roundTripMDA(fname, tempName=None, repeat=3, useNumpy=False)
+
+    Benchmark for development: read MDA file fname, write it to tempName (a
+    temporary file by default), and read that back, best time of 'repeat' tries
+    of each.  Prints the times and rates and whether the data read back are
+    the same; returns True if they are.
+    """
+    import tempfile, time
+    if tempName == None:
+        (handle, tempName) = tempfile.mkstemp(suffix='.mda')
+        os.close(handle)
+    def best(function):
+        times = []
+        for i in range(repeat):
+            t0 = time.time()
+            result = function()
+            times.append(time.time() - t0)
+        return (min(times), result)
+    try:
+        (tRead, dim) = best(lambda: readMDA(fname, useNumpy=useNumpy))
+        (tWrite, result) = best(lambda: writeMDA(dim, tempName))
+        (tReread, again) = best(lambda: readMDA(tempName, useNumpy=useNumpy))
+        size = os.path.getsize(tempName)
+    finally:
+        os.remove(tempName)
+
+    same = (len(dim) == len(again))
+    for (a, b) in zip(dim[1:], again[1:]):
+        for (x, y) in zip(a.p + a.d, b.p + b.d):
+            if useNumpy:
+                same = same and numpy.array_equal(x.data, y.data)
+            else:
+                same = same and (x.data == y.data)
+    mb = size / 1.0e6
+    print "%s: %d-D, acquired %s, %.2f MB" % (fname, dim[0]['rank'], str(dim[0]['acquired_dimensions']), mb)
+    print "   readMDA   %8.4f s  %8.1f MB/s" % (tRead, mb / max(tRead, 1e-9))
+    print "   writeMDA  %8.4f s  %8.1f MB/s" % (tWrite, mb / max(tWrite, 1e-9))
+    print "   read back %8.4f s  %8.1f MB/s  data %s" % (tReread, mb / max(tReread, 1e-9), {True: 'same', False: 'DIFFERENT'}[bool(same)])
+    return bool(same)
+
 ################################################################################
 # write Ascii file
 def getFormat(d, rank):
@@ -1416,7 +2256,7 @@ def getDescFromEnv(data):
 ########################
 def isScan(d):
     if type(d) != type([]): return(0)
-    if type(d[0]) != type({}): return(0)
+    if not isinstance(d[0], (type({}), lazyEnvDict)): return(0)
     if 'rank' not in d[0].keys(): return(0)
     if len(d) < 2: return(0)
     if type(d[1]) != type(scanDim()): return(0)
@@ -1449,60 +2289,100 @@ def opMDA_usage():
     print "\nwhere:"
     print "   op is one of '+', '-', '*', '/', '>', '<'"
     print "   scan1, scan2 are scans, i.e., structures returned by mda.readMDA()"
-    print "   result is a copy of scan1, modified by the operation\n"
+    print "   result is a copy of scan1 (sharing all but the detector data), modified by the operation\n"
+    print "   with opMDA(op, scan1, scan2, inplace=True), scan1 itself is modified\n"
     print "\n examples:"
     print "   r = opMDA('+', scan1, scan2) -- adds all detector data from scan1 and scan2"
     print "   r = opMDA('-', scan1, 2.0)   -- subtracts 2 from all detector data from scan1"
     print "   r = opMDA('>', r, 0)         -- 'r' data or 0, whichever is greater"
 
-def opMDA_scalar(op, d1, scalar):
+# numpy functions for the operators of setOp(), used on whole arrays at once
+def numpyOp(op):
+    if not have_numpy: return None
+    ufuncs = {add: numpy.add, sub: numpy.subtract, mul: numpy.multiply,
+              div: numpy.divide, max: numpy.maximum, min: numpy.minimum}
+    return ufuncs.get(op)
+
+# shape of (nested) data: the lengths along the first element of each level
+def dataShape(data):
+    if have_numpy and isinstance(data, numpy.ndarray):
+        return data.shape
+    shape = []
+    while hasattr(data, '__len__'):
+        shape.append(len(data))
+        if len(data) == 0: break
+        data = data[0]
+    return tuple(shape)
+
+# op applied to each element of (nested) data a, and b (nested data of the
+# same shape, or a scalar), one Python call per element
+def opNested(op, a, b):
+    scalar = isScalar(b)
+    if (len(a) > 0) and hasattr(a[0], '__len__'):
+        if scalar: return [opNested(op, x, b) for x in a]
+        return [opNested(op, x, y) for (x, y) in zip(a, b)]
+    if scalar: return [op(x, b) for x in a]
+    return map(op, a, b)
+
+# op applied to all of detector data a and b (data of the same shape, or a
+# scalar), on whole numpy arrays when possible.  numpy arrays give numpy
+# arrays (with inplace, a is overwritten), lists give lists.
+def opData(op, a, b, inplace=False):
+    ufunc = numpyOp(op)
+    if (ufunc != None):
+        x = numpy.asarray(a)
+        if isScalar(b): y = b
+        else: y = numpy.asarray(b)
+        if (x.dtype != object) and (isScalar(b) or (y.dtype != object)):
+            if isinstance(a, numpy.ndarray):
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    if inplace and a.flags.writeable:
+                        return ufunc(a, y, out=a, casting='unsafe')
+                    return ufunc(a, y).astype(a.dtype, copy=False)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return ufunc(x, y).tolist()
+    return opNested(op, a, b)
+
+# a scan that shares everything with d but its detectors, whose data will be
+# replaced by the results of an operation
+def copyDetectors(d):
+    s = [d[0]]
+    for scan in d[1:]:
+        t = copy.copy(scan)
+        t.d = [copy.copy(det) for det in scan.d]
+        s.append(t)
+    return s
+
+def opMDA_scalar(op, d1, scalar, inplace=False):
+    """usage: result = opMDA_scalar(op, d1, scalar, inplace=False)
+
+    op applied to all detector data of scan d1 and scalar, whole arrays at a
+    time.  The result shares all but the detector data with d1 (inplace:
+    d1 itself is changed and returned).
+    """
     op = setOp(op)
     if (op == None):
         opMDA_usage()
         return None
 
-    s = copy.deepcopy(d1)
-
-    # 1D op
-    for i in range(s[1].nd):
-        for j in range(s[1].npts):
-            s[1].d[i].data[j] = op(s[1].d[i].data[j], scalar)
-
-    if (len(s) == 2): return s
-    # 2D op
-    for i in range(s[2].nd):
-        for j in range(s[1].npts):
-            for k in range(s[2].npts):
-                s[2].d[i].data[j][k] = op(s[2].d[i].data[j][k], scalar)
-
-    if (len(s) == 3): return s
-    # 3D op
-    for i in range(s[3].nd):
-        for j in range(s[1].npts):
-            for k in range(s[2].npts):
-                for l in range(s[3].npts):
-                    s[3].d[i].data[j][k][l] = op(s[3].d[i].data[j][k][l], scalar)
-            
-    if (len(s) == 4): return s
-    # 4D op
-    for i in range(s[4].nd):
-        for j in range(s[1].npts):
-            for k in range(s[2].npts):
-                for l in range(s[3].npts):
-                    for m in range(s[4].npts):
-                        s[4].d[i].data[j][k][l][m] = op(s[4].d[i].data[j][k][l][m], scalar)
-
-    if (len(s) > 4):
-        print "opMDA supports up to 4D scans"
+    if inplace: s = d1
+    else: s = copyDetectors(d1)
+    for scan in s[1:]:
+        for det in scan.d:
+            det.data = opData(op, det.data, scalar, inplace)
     return s
 
-def opMDA(op, d1, d2):
+def opMDA(op, d1, d2, inplace=False):
     """opMDA() is a function for performing arithmetic operations on MDA files,
     or on an MDA file and a scalar value.
 
+    The operation is done on whole detector arrays at a time (with numpy).
+    The result shares all but the detector data with d1; with inplace=True,
+    d1 itself is changed and returned.
+
     For examples, type 'opMDA_usage()'.
     """
-    if isScan(d1) and isScalar(d2): return(opMDA_scalar(op,d1,d2))
+    if isScan(d1) and isScalar(d2): return(opMDA_scalar(op,d1,d2,inplace))
     if (not isScan(d1)) :
         print "opMDA: first operand is not a scan"
         opMDA_usage()
@@ -1522,59 +2402,271 @@ def opMDA(op, d1, d2):
         opMDA_usage()
         return None
 
-    s = copy.deepcopy(d1)
-
-    # 1D op
-    if s[1].nd != d2[1].nd:
-        print "scans do not have same number of 1D detectors"
-        return None
-    if s[1].npts != d2[1].npts:
-        print "scans do not have same number of data points"
-        return None
-    for i in range(s[1].nd):
-        s[1].d[i].data = map(op, s[1].d[i].data, d2[1].d[i].data)
+    # check everything before changing anything
+    for dimNum in range(1, len(d1)):
+        if d1[dimNum].nd != d2[dimNum].nd:
+            print "scans do not have same number of %dD detectors" % dimNum
+            return None
+        if d1[dimNum].npts != d2[dimNum].npts:
+            print "scans do not have same number of data points"
+            return None
+        for i in range(d1[dimNum].nd):
+            if dataShape(d1[dimNum].d[i].data) != dataShape(d2[dimNum].d[i].data):
+                print "scans do not have same number of data points"
+                return None
+
+    if inplace: s = d1
+    else: s = copyDetectors(d1)
+    for dimNum in range(1, len(s)):
+        for i in range(s[dimNum].nd):
+            s[dimNum].d[i].data = opData(op, s[dimNum].d[i].data, d2[dimNum].d[i].data, inplace)
+    return s
 
-    if (len(s) == 2): return s
-    # 2D op
-    if s[2].nd != d2[2].nd:
-        print "scans do not have same number of 2D detectors"
-        return None
-    if s[2].npts != d2[2].npts:
-        print "scans do not have same number of data points"
-        return None
-    for i in range(s[2].nd):
-        for j in range(s[1].npts):
-            s[2].d[i].data[j] = map(op, s[2].d[i].data[j], d2[2].d[i].data[j])
-
-    if (len(s) == 3): return s
-    # 3D op
-    if s[3].nd != d2[3].nd:
-        print "scans do not have same number of 3D detectors"
-        return None
-    if s[3].npts != d2[3].npts:
-        print "scans do not have same number of data points"
+########################################
+# expressions of detector data (exprMDA)
+########################################
+# functions that can be called in expressions, by name
+exprFunctionNames = {'abs': 'absolute', 'sqrt': 'sqrt', 'exp': 'exp', 'log': 'log',
+    'log10': 'log10', 'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'arcsin': 'arcsin',
+    'arccos': 'arccos', 'arctan': 'arctan', 'arctan2': 'arctan2', 'sign': 'sign',
+    'floor': 'floor', 'ceil': 'ceil', 'minimum': 'minimum', 'maximum': 'maximum',
+    'where': 'where', 'clip': 'clip'}
+exprConstantNames = {'pi': 'pi'}
+# syntax allowed in expressions: arithmetic, single comparisons, and calls
+exprNodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Num,
+    ast.Name, ast.Attribute, ast.Call, ast.Load, ast.Add, ast.Sub, ast.Mult,
+    ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd, ast.Gt, ast.Lt, ast.GtE,
+    ast.LtE, ast.Eq, ast.NotEq)
+# scan-record fields that can be referenced: detectors D01-D99, positioners P1-P4
+exprFieldPattern = re.compile(r'^([DP])0*([1-9][0-9]?)$')
+
+def isNumeric(node):
+    """true if an expression node is made of numbers only (no other names)"""
+    return not [n for n in ast.walk(node)
+                if isinstance(n, ast.Name) and not n.id.startswith('_num')]
+
+# checks the syntax tree of an expression, and replaces each reference to a
+# detector or positioner ('D05', 'scanA.D05') by a placeholder name
+class exprTransformer(ast.NodeTransformer):
+    def __init__(self):
+        self.refs = []    # (scan name or None, fieldName), by placeholder number
+        self.numbers = [] # numpy.float64 values of the numbers, by placeholder number
+
+    def reference(self, scanName, field, node):
+        m = exprFieldPattern.match(field)
+        if m is None:
+            raise ValueError("unknown name '%s'" % field)
+        if m.group(1) == 'D':
+            field = detName(int(m.group(2)) - 1)
+        elif int(m.group(2)) <= 4:
+            field = posName(int(m.group(2)) - 1)
+        else:
+            raise ValueError("unknown positioner '%s'" % field)
+        if (scanName, field) not in self.refs:
+            self.refs.append((scanName, field))
+        name = ast.Name(id='_ref%d' % self.refs.index((scanName, field)), ctx=ast.Load())
+        return ast.copy_location(name, node)
+
+    def visit_Num(self, node):
+        # a name, not a literal: compile() does no arithmetic on it, and numpy
+        # (not python) does the arithmetic, within numpy.errstate()
+        if isinstance(node.n, complex):
+            raise ValueError("complex numbers are not allowed")
+        try:
+            self.numbers.append(numpy.float64(node.n))
+        except OverflowError:
+            raise ValueError("number too large: %s" % node.n)
+        name = ast.Name(id='_num%d' % (len(self.numbers) - 1), ctx=ast.Load())
+        return ast.copy_location(name, node)
+
+    def visit_Name(self, node):
+        if node.id in exprConstantNames: return node
+        return self.reference(None, node.id, node)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.value, ast.Name):
+            raise ValueError("only 'scan.field' references are allowed")
+        return self.reference(node.value.id, node.attr, node)
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name):
+            raise ValueError("only functions can be called in expressions")
+        if node.func.id not in exprFunctionNames:
+            raise ValueError("unknown function '%s'" % node.func.id)
+        if node.keywords or node.starargs or node.kwargs:
+            raise ValueError("%s(): only positional arguments are allowed" % node.func.id)
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        # compile() folds constant expressions, and would compute 9**9**9
+        if isinstance(node.op, ast.Pow) and isNumeric(node.left) and isNumeric(node.right):
+            raise ValueError("'**' needs a detector or positioner on one side")
+        return node
+
+    def visit_Compare(self, node):
+        if len(node.ops) > 1:
+            raise ValueError("chained comparisons are not allowed")
+        return self.generic_visit(node)
+
+    def generic_visit(self, node):
+        if not isinstance(node, exprNodes):
+            raise ValueError("'%s' is not allowed in expressions" % node.__class__.__name__)
+        return ast.NodeTransformer.generic_visit(self, node)
+
+class MdaExpr:
+    """usage: e = MdaExpr(expr)
+
+    An arithmetic expression of detectors (D01-D99) and positioners (P1-P4),
+    checked and compiled once, then evaluated on whole numpy arrays for any
+    number of scans (structures returned by readMDA()).  For example:
+
+        e = MdaExpr("D05 / D01 * 1e5")
+        det = e.detector(d)            -- new scanDetector from scan d
+        values = e.evaluate(d)         -- numpy array only
+
+        e = MdaExpr("scanA.D12 - scanB.D12")
+        det = e.detector(d1, scans={'scanA': d1, 'scanB': d2})
+
+    Plain names refer to scan d, 'name.field' to scans[name].  Expressions
+    may use numbers, + - * / ** %, one comparison, pi and the functions
+    abs, sqrt, exp, log, log10, sin, cos, tan, arcsin, arccos, arctan,
+    arctan2, sign, floor, ceil, minimum, maximum, where, clip; '**' needs a
+    detector or positioner on one side.  Anything else raises ValueError, so
+    the expression can come from a user.
+
+    The data are taken from the same dimension of each scan (by default the
+    innermost dimension read from all of them); only referenced detectors
+    and positioners are converted.  Numbers are numpy.float64, so division by
+    zero and overflow give inf or nan.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        try:
+            tree = ast.parse(expr.strip(), '<MdaExpr>', 'eval')
+        except SyntaxError, e:
+            raise ValueError("syntax error in '%s': %s" % (expr, e.msg))
+        transformer = exprTransformer()
+        tree = ast.fix_missing_locations(transformer.visit(tree))
+        self.refs = transformer.refs
+        self.numbers = transformer.numbers
+        if len(self.refs) == 0:
+            raise ValueError("'%s' uses no detector or positioner" % expr)
+        self.code = compile(tree, '<MdaExpr>', 'eval')
+
+    def scanOf(self, scanName, d, scans):
+        if scanName == None:
+            if d == None: raise ValueError("'%s' needs a scan" % self.expr)
+            return d
+        if (scans == None) or (scanName not in scans):
+            raise ValueError("no scan named '%s'" % scanName)
+        return scans[scanName]
+
+    def dimension(self, d=None, scans=None):
+        """innermost dimension read from all scans referenced"""
+        return min([len(self.scanOf(name, d, scans)) for (name, field) in self.refs]) - 1
+
+    def references(self, d=None, dimNum=None, scans=None):
+        """detectors and positioners referenced by the expression, by placeholder number"""
+        if dimNum == None: dimNum = self.dimension(d, scans)
+        found = []
+        for (scanName, field) in self.refs:
+            scan = self.scanOf(scanName, d, scans)
+            if (dimNum < 1) or (dimNum >= len(scan)):
+                raise ValueError("no %dD data for '%s'" % (dimNum, field))
+            x = [x for x in scan[dimNum].d + scan[dimNum].p if x.fieldName == field]
+            if len(x) == 0:
+                raise ValueError("no %dD detector or positioner '%s'" % (dimNum, field))
+            found.append(x[0])
+        return found
+
+    def evaluate(self, d=None, dimNum=None, scans=None):
+        """usage: values = e.evaluate(d=None, dimNum=None, scans=None)"""
+        namespace = {}
+        for (i, x) in enumerate(self.references(d, dimNum, scans)):
+            a = numpy.asarray(x.data)
+            if a.dtype == object:
+                raise ValueError("'%s' data are not a regular array" % x.fieldName)
+            namespace['_ref%d' % i] = a
+        for (i, value) in enumerate(self.numbers):
+            namespace['_num%d' % i] = value
+        for (name, attr) in exprFunctionNames.items():
+            namespace[name] = getattr(numpy, attr)
+        for (name, attr) in exprConstantNames.items():
+            namespace[name] = numpy.float64(getattr(numpy, attr))
+        try:
+            with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                return eval(self.code, {'__builtins__': {}}, namespace)
+        except (TypeError, ArithmeticError), msg:
+            raise ValueError("'%s': %s" % (self.expr, msg))
+
+    def detector(self, d=None, dimNum=None, scans=None, number=None):
+        """usage: det = e.detector(d=None, dimNum=None, scans=None, number=None)
+
+        New scanDetector with the values of the expression.  Its number
+        (default: after the last detector of d[dimNum]) gives its fieldName,
+        its name and description are the expression.  The data are a numpy
+        array, or lists if all referenced data are lists.
+        """
+        if dimNum == None: dimNum = self.dimension(d, scans)
+        found = self.references(d, dimNum, scans)
+        values = self.evaluate(d, dimNum, scans)
+        if number == None:
+            target = d or self.scanOf(self.refs[0][0], d, scans)
+            number = max([x.number for x in target[dimNum].d] + [-1]) + 1
+        det = scanDetector()
+        det.number = number
+        det.fieldName = detName(number)
+        det.name = self.expr
+        det.desc = self.expr
+        det.data = values
+        if not [x for x in found if isinstance(x.data, numpy.ndarray)]:
+            det.data = numpy.asarray(values).tolist()
+        return det
+
+exprCache = {}        # compiled expressions by text, for exprMDA()
+exprCacheSize = 64
+
+def compileExpr(expr):
+    """MdaExpr(expr), compiled once for repeated calls with the same text"""
+    e = exprCache.get(expr)
+    if e == None:
+        if len(exprCache) >= exprCacheSize: exprCache.clear()
+        e = exprCache[expr] = MdaExpr(expr)
+    return e
+
+def exprMDA(expr, d, dimNum=None, scans=None, inplace=False):
+    """usage: result = exprMDA(expr, d, dimNum=None, scans=None, inplace=False)
+
+    Appends a detector with the values of expr (see MdaExpr) to d[dimNum].
+    The result shares all but d[dimNum] with d; with inplace=True, d itself
+    is changed and returned.  Example, for I0 normalization of many scans:
+
+        scans = [exprMDA("D05 / D01 * 1e5", readMDA(f, useNumpy=True)) for f in files]
+    """
+    if not have_numpy:
+        print "exprMDA: requires the python 'numpy' package, but we can't import it."
         return None
-    for i in range(s[3].nd):
-        for j in range(s[1].npts):
-            for k in range(s[2].npts):
-                s[3].d[i].data[j][k] = map(op, s[3].d[i].data[j][k], d2[3].d[i].data[j][k])
-            
-    if (len(s) == 4): return s
-    # 3D op
-    if s[4].nd != d2[4].nd:
-        print "scans do not have same number of 4D detectors"
+    if (not isScan(d)):
+        print "exprMDA: second argument is not a scan"
         return None
-    if s[4].npts != d2[4].npts:
-        print "scans do not have same number of data points"
+    try:
+        e = compileExpr(expr)
+        if dimNum == None: dimNum = e.dimension(d, scans)
+        det = e.detector(d, dimNum, scans)
+    except ValueError, msg:
+        print "exprMDA:", msg
         return None
-    for i in range(s[4].nd):
-        for j in range(s[1].npts):
-            for k in range(s[2].npts):
-                for l in range(s[3].npts):
-                    s[4].d[i].data[j][k][l] = map(op, s[4].d[i].data[j][k][l], d2[4].d[i].data[j][k][l])
-
-    if (len(s) > 5):
-        print "opMDA supports up to 4D scans"
+
+    if inplace:
+        s = d
+    else:
+        s = list(d)
+        s[dimNum] = copy.copy(d[dimNum])
+        s[dimNum].d = list(d[dimNum].d)
+    s[dimNum].d.append(det)
+    s[dimNum].nd = len(s[dimNum].d)
     return s
 
 #######################################
@@ -30,6 +30,8 @@ Features
 * preview brief header or full summary of MDA file (^B)
 * convert one selected MDA file to ASCII (^S)
 * convert entire directory of MDA files to ASCII (^D)
+* stop converting (^K)
+* files are read and converted in the background, the window stays responsive
 
 ---------------
 
@@ -39,22 +41,29 @@ Source Code Documentation
 .. autosummary::
 
     ~MainWindow
+    ~BackgroundWorker
+    ~SummaryCache
+    ~convertMdaFile
 
 --------------
 
 """
 
 
+import collections
 import optparse
 import datetime
 import glob
 import platform
 import os
+import Queue
 import sys
+import threading
 import traceback
 import wx
 from xml.etree import ElementTree
 from xml.dom import minidom
+import mda2idd_index
 import mda2idd_report
 import mda2idd_summary
 
@@ -67,6 +76,9 @@ __url__ = "https://github.com/BCDA-APS/mda2idd_report"
 
 
 RC_FILE = ".mda2idd_gui_rc.xml"
+SUMMARY_CACHE_BYTES = 32*1024*1024  # memory for summaries of recently-viewed MDA files
+PREFS_WRITE_DELAY_S = 5.0           # changed preferences are written at most this often
+INDEX_WRITE_DELAY_S = 10.0          # changed directory indexes are written at most this often
 
 
 class MainWindow(wx.Frame):
@@ -82,7 +94,14 @@ class MainWindow(wx.Frame):
         self.startup_complete = False
         self.selectedMdaFile = None
         self.preferences_file = self.GetDefaultPreferencesFileName()
+        self.prefs_timer = None     # pending write of changed preferences
+        self.index_timer = None     # pending write of changed directory indexes
         self.mrud = []      # most-recently-used directories
+        self.previewer = BackgroundWorker()     # summaries of selected files
+        self.summaries = SummaryCache()         # used only by the previewer thread
+        self.converter = BackgroundWorker()     # MDA to ASCII conversions
+        self.indexWriter = BackgroundWorker()   # directory index files, never cancelled
+        self.conversions = [0, 0]               # number done, number requested
         
         self.getPreferences(start_fresh)
         
@@ -111,6 +130,12 @@ class MainWindow(wx.Frame):
             id=wx.ID_ANY,
             help=u'Convert all MDA files in current directory to ASCII text files')
         self.Bind(wx.EVT_MENU, self.OnConvertAll, id=item.GetId())
+
+        item = self.menu_file.Append(
+            text=u'Stop &Converting\tCtrl+K', 
+            id=wx.ID_ANY,
+            help=u'Cancel the conversions not yet done')
+        self.Bind(wx.EVT_MENU, self.OnCancelConversions, id=item.GetId())
         
         self.menu_file.AppendSeparator()
 
@@ -196,6 +221,7 @@ class MainWindow(wx.Frame):
         #self.Bind(wx.EVT_SIZE, self.OnWindowGeometryChanged)
         self.Bind(wx.EVT_MOVE, self.OnWindowGeometryChanged)
         self.Bind(wx.EVT_DIRPICKER_CHANGED, self.OnSelectDirPicker)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
         self.SetSizerAndFit(sizer)
         
@@ -262,11 +288,11 @@ class MainWindow(wx.Frame):
     def OnSashMoved(self, event):
         '''user moved the sash'''
         self.prefs['sash_pos'] = self.splitter1.GetSashPosition()
-        self.writePreferences()
+        self.preferencesChanged()
         
     def OnWindowGeometryChanged(self, event):
         '''user changed the window size or position'''
-        self.writePreferences()
+        self.preferencesChanged()
         
     def OnSelectTreeCtrlItem(self, event):
         '''user selected something in the directory list tree control'''
@@ -278,13 +304,12 @@ class MainWindow(wx.Frame):
         self.setStatusText( 'selected: ' + selectedItem )
         if os.path.exists(selectedItem):
             if os.path.isfile(selectedItem):
-                checked = self.menu_file.IsChecked(self.id_menu_report)
-                summary = mda2idd_summary.summaryMda(selectedItem, checked)
-                self.setSummaryText(summary)
                 self.selectedMdaFile = selectedItem
+                self.showSummary(selectedItem)
                 self.update_mrud(os.path.dirname(selectedItem))
                 path = os.path.dirname(selectedItem)
                 if path != self.prefs['start_dir']:
+                    self.writeIndexes()
                     self.prefs['start_dir'] = path
                     self.update_mrud(path)
                     self.dirPicker.SetPath( path )
@@ -293,7 +318,7 @@ class MainWindow(wx.Frame):
                 #self.prefs['start_dir'] = selectedItem
                 #self.update_mrud(selectedItem)
                 self.dirPicker.SetPath( selectedItem )
-            self.writePreferences()
+            self.preferencesChanged()
     
     def OnSelectDirPicker(self, event):
         '''user changed the text or browsed to a directory in the picker'''
@@ -304,24 +329,32 @@ class MainWindow(wx.Frame):
         selectedItem = self.dirPicker.GetPath()
         if os.path.exists(selectedItem):
             if os.path.isdir(selectedItem):
+                self.writeIndexes()
                 self.prefs['start_dir'] = selectedItem
                 self.update_mrud(selectedItem)
                 self.dir.ExpandPath(selectedItem)
+                self.preferencesChanged()
 
     def OnMenuFileItemSave(self, event):
         '''save the selected MDA file as ASCII'''
         if self.selectedMdaFile is not None and os.path.exists(self.selectedMdaFile):
             self.setStatusText("converting MDA file %s to ASCII text" % self.selectedMdaFile)
-            converted = mda2idd_report.report(self.selectedMdaFile)
-            if self.selectedMdaFile in converted:
-                msg = "converted MDA file " + self.selectedMdaFile
-                num = len(converted[self.selectedMdaFile])
-                msg += " to %d ASCII text file" % num
-                if num > 1:
-                    msg += "s"  # plural
-                self.setStatusText(msg)
-            else:
-                self.setStatusText("No ASCII files written from " + self.selectedMdaFile)
+            self.converter.submit(self.reportSave, mda2idd_report.report, self.selectedMdaFile)
+
+    def reportSave(self, converted):
+        '''conversion of one MDA file (from File --> Save) is done'''
+        if not isinstance(converted, dict):
+            self.setStatusText("Could not convert: " + str(converted).strip().splitlines()[-1])
+        elif len(converted) > 0:
+            mdaFile, asciiFiles = converted.items()[0]
+            msg = "converted MDA file " + mdaFile
+            num = len(asciiFiles)
+            msg += " to %d ASCII text file" % num
+            if num > 1:
+                msg += "s"  # plural
+            self.setStatusText(msg)
+        else:
+            self.setStatusText("No ASCII files written")
     
     def OnMenuFileItemPrefs(self, event):
         '''save the preferences to a file'''
@@ -330,9 +363,46 @@ class MainWindow(wx.Frame):
     
     def OnMenuFileItemReportStyle(self, event):
         if self.selectedMdaFile is not None and os.path.exists(self.selectedMdaFile):
-            checked = self.menu_file.IsChecked(self.id_menu_report)
-            summary = mda2idd_summary.summaryMda(self.selectedMdaFile, checked)
-            self.setSummaryText(summary)
+            self.showSummary(self.selectedMdaFile)
+        self.preferencesChanged()
+
+    def showSummary(self, mdaFile):
+        '''show the summary of an MDA file, read in the background'''
+        checked = self.menu_file.IsChecked(self.id_menu_report)
+        self.previewer.cancel()         # only the latest selection matters
+        self.setSummaryText('reading: ' + mdaFile)
+        self.previewer.submit(self.summaryRead, self.summaries.summary, mdaFile, checked)
+
+    def summaryRead(self, text):
+        '''the summary of the selected MDA file has been read'''
+        self.setSummaryText(text)
+        self.indexChanged()
+
+    def indexChanged(self):
+        '''
+        remember to save the directory index (see :mod:`mda2idd_index`)
+        
+        Reading a new or changed MDA file changes the index of its directory,
+        the index files are written at most once each INDEX_WRITE_DELAY_S seconds,
+        when another directory is chosen, and when the window is closed.
+        '''
+        if self.index_timer is None:
+            self.index_timer = wx.CallLater(int(1000*INDEX_WRITE_DELAY_S), self.writeIndexes)
+
+    def writeIndexes(self, wait=False):
+        '''write the changed directory index files, in the background unless ``wait``'''
+        if self.index_timer is not None:
+            self.index_timer.Stop()
+            self.index_timer = None
+        if wait:
+            mda2idd_index.saveIndexes()
+        else:
+            self.indexWriter.submit(self.indexesWritten, mda2idd_index.saveIndexes)
+
+    def indexesWritten(self, result):
+        '''the directory index files have been written (or not)'''
+        if not isinstance(result, int):
+            self.setStatusText('could not write directory index: ' + str(result).strip().splitlines()[-1])
 
     def OnMenuFileItemExit(self, event):
         '''
@@ -341,9 +411,20 @@ class MainWindow(wx.Frame):
         :param event: wxPython event object
         '''
         # TODO: does not get here in RHEL5
-        self.writePreferences()
         self.Close()
     
+    def OnClose(self, event):
+        '''
+        the window is closing: stop the background work, write the preferences and indexes
+        
+        :param event: wxPython event object
+        '''
+        self.previewer.cancel()
+        self.converter.cancel()
+        self.writePreferences()     # also saves the window size
+        self.writeIndexes(wait=True)    # worker threads end with the program
+        event.Skip()
+    
     def setCurrentDirectory(self, directory):
         '''set the current directory'''
         self.dir.ExpandPath(directory)
@@ -356,9 +437,6 @@ class MainWindow(wx.Frame):
     def appendSummaryText(self, text):
         '''post new text to the summary TextCtrl, appending to any existing text'''
         self.textCtrl1.AppendText(str(text))
-        # FIXME: self.textCtrl1.Refresh()
-        # Refresh() won't work here since the caller does not let the window get redrawn
-        # Refactor to update as loop through MDA files progresses.
     
     def setStatusText(self, text):
         '''post new text to the status bar'''
@@ -418,8 +496,22 @@ class MainWindow(wx.Frame):
         self.prefs['short_summary'] = node is None or 'true' == node.text.strip().lower()
         self.prefs['start_dir'] = root.find('starting_directory').text.strip()
 
+    def preferencesChanged(self):
+        '''
+        remember to save the program prefs
+        
+        Called for every change (such as each step of a window move),
+        the file is written at most once each PREFS_WRITE_DELAY_S seconds
+        and when the window is closed.
+        '''
+        if self.prefs_timer is None:
+            self.prefs_timer = wx.CallLater(int(1000*PREFS_WRITE_DELAY_S), self.writePreferences)
+
     def writePreferences(self):
         '''save program prefs to a file'''
+        if self.prefs_timer is not None:
+            self.prefs_timer.Stop()
+            self.prefs_timer = None
         if self.preferences_file is None:
             return
         
@@ -471,9 +563,10 @@ class MainWindow(wx.Frame):
         doc = minidom.parseString(ElementTree.tostring(root))
         xmlText = doc.toprettyxml(indent = "  ", encoding='UTF-8')
         
-        f = open(self.preferences_file, 'w')
-        f.write(xmlText)
-        f.close()
+        try:
+            mda2idd_index.writeFileAtomically(self.preferences_file, xmlText)
+        except (IOError, OSError) as exc:
+            self.setStatusText('could not write preferences file: ' + str(exc))
     
     def update_mrud(self, newdir):
         '''MRUD: list of most-recently-used directories'''
@@ -547,33 +640,34 @@ class MainWindow(wx.Frame):
         self.setStatusText('Converting all MDA files to ASCII in directory: ' + path)
         self.convertMdaDir(path)
         
+    def OnCancelConversions(self, event):
+        '''selected the "Stop Converting" menu item'''
+        done, requested = self.conversions
+        self.converter.cancel()
+        self.conversions = [0, 0]
+        if requested > done:
+            self.appendSummaryText('\n* stopped, %d files not converted' % (requested - done))
+            self.setStatusText('Stopped converting MDA files')
+        
     def convertMdaDir(self, path):
-        '''convert all MDA files in a given directory'''
+        '''convert all MDA files in a given directory, in the background'''
         fileList = self.listMdaFiles(path)
         if len(fileList) == 0:
             self.setSummaryText('No MDA files to convert in directory: ' + path)
             return
         self.setSummaryText('Converting these files:\n')
-        known_exceptions = (
-            mda2idd_report.ReadMdaException,    # some problem reading the MDA file
-            mda2idd_report.RankException,       # only handle 1-D and 2-D scans
-            IndexError,                         # requested array index is not available
-            OSError,                            # 1 case: could not create ../ASCII directory
-            Exception,                          # anything at all
-        )
+        self.conversions[1] += len(fileList)
         for mdaFile in sorted(fileList):
-            try:
-                msg = ''
-                answer = mda2idd_report.report(mdaFile, allowException=True)
-                for k, v in answer.items():
-                    msg += '\n* ' + k + ' --> '  # + str(v)
-                    msg += "\n  " + "\n  ".join(v)
-            except known_exceptions as answer:
-                problem = mdaFile + '\n' + traceback.format_exc()
-                # self.messageDialog('problem', problem)
-                # return
-                msg += '\n* ' + problem
-            self.appendSummaryText(msg)
+            self.converter.submit(self.reportConversion, convertMdaFile, mdaFile)
+
+    def reportConversion(self, msg):
+        '''one MDA file of convertMdaDir() is done'''
+        self.appendSummaryText(msg)
+        self.conversions[0] += 1
+        done, requested = self.conversions
+        self.setStatusText('Converted %d of %d MDA files to ASCII' % (done, requested))
+        if done == requested:
+            self.conversions = [0, 0]
     
     def listMdaFiles(self, path):
         '''return a list of all MDA files in the path directory'''
@@ -599,6 +693,165 @@ class MainWindow(wx.Frame):
         return result
 
 
+class BackgroundWorker(object):
+    '''
+    run jobs in worker threads and pass their results back to the GUI thread
+    
+    Each result is put in a result queue; the GUI thread is told
+    with ``wx.CallAfter()`` to hand it to the job's callback.
+    A job that raises an exception returns the traceback text.
+    
+    :param int num_threads: number of worker threads
+    '''
+    
+    def __init__(self, num_threads=1):
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.generation = 0     # cancel() starts a new generation of jobs
+        for i in range(num_threads):
+            thread = threading.Thread(target=self.run)
+            thread.setDaemon(True)
+            thread.start()
+    
+    def submit(self, callback, function, *args):
+        '''run ``function(*args)`` in a worker thread, then ``callback(result)`` in the GUI thread'''
+        self.jobs.put((self.generation, callback, function, args))
+    
+    def cancel(self):
+        '''
+        forget all jobs not yet done
+        
+        A job that is running when this is called finishes, but its
+        callback is not called.
+        '''
+        self.generation += 1
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except Queue.Empty:
+                break
+    
+    def run(self):
+        '''worker thread: do the jobs'''
+        while True:
+            generation, callback, function, args = self.jobs.get()
+            if generation != self.generation:
+                continue        # cancelled
+            try:
+                result = function(*args)
+            except Exception:
+                result = traceback.format_exc()
+            self.results.put((generation, callback, result))
+            wx.CallAfter(self.deliver)
+    
+    def deliver(self):
+        '''GUI thread: pass the results to their callbacks'''
+        while True:
+            try:
+                generation, callback, result = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            if generation == self.generation:
+                callback(result)
+
+
+class SummaryCache(object):
+    '''
+    summaries of the most-recently-viewed MDA files
+    
+    Both the header information read from the file and the summary text
+    are kept, keyed by (file name, modification time, size, short report),
+    so a file is read again only when it changes.  When the estimated memory
+    used by all entries exceeds *max_bytes*, the least-recently-used
+    entries are dropped.
+    
+    :param int max_bytes: most memory (estimated) for all the entries
+    '''
+    
+    def __init__(self, max_bytes=SUMMARY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()    # key: (data, text, size), oldest first
+        self.total = 0
+        self.lock = threading.Lock()
+    
+    def summary(self, mdaFileName, shortReport=True):
+        '''text summary of an MDA file, as from :func:`mda2idd_summary.summaryMda`'''
+        return self.lookup(mdaFileName, shortReport)[1]
+    
+    def lookup(self, mdaFileName, shortReport=True):
+        '''``(data, text)`` of an MDA file, as from :func:`mda2idd_summary.readSummary`'''
+        try:
+            st = os.stat(mdaFileName)
+        except OSError:
+            return mda2idd_summary.readSummary(mdaFileName, shortReport, saveIndex=False)
+        path = os.path.abspath(mdaFileName)
+        key = (path, st.st_mtime, st.st_size, bool(shortReport))
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry       # now the most recent
+                return entry[:2]
+        data, text = mda2idd_summary.readSummary(mdaFileName, shortReport, saveIndex=False)
+        with self.lock:
+            # entries of an older version of this file will not be used again
+            for old in [k for k in self.entries if k[0] == path and k[3] == key[3]]:
+                self.total -= self.entries.pop(old)[2]
+            size = estimateSize((data, text))
+            self.entries[key] = (data, text, size)
+            self.total += size
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                self.total -= self.entries.popitem(last=False)[1][2]
+        return data, text
+    
+    def clear(self):
+        '''forget all entries'''
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
+
+
+def estimateSize(obj):
+    '''estimated memory (bytes) used by ``obj`` and everything it refers to'''
+    seen = set()
+    todo = [obj]
+    size = 0
+    while len(todo) > 0:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            todo.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            todo.append(obj.__dict__)
+    return size
+
+
+def convertMdaFile(mdaFile):
+    '''convert one MDA file to ASCII, return a text report of what was done'''
+    known_exceptions = (
+        mda2idd_report.ReadMdaException,    # some problem reading the MDA file
+        mda2idd_report.RankException,       # only handle 1-D and 2-D scans
+        IndexError,                         # requested array index is not available
+        OSError,                            # 1 case: could not create ../ASCII directory
+        Exception,                          # anything at all
+    )
+    try:
+        msg = ''
+        answer = mda2idd_report.report(mdaFile, allowException=True)
+        for k, v in answer.items():
+            msg += '\n* ' + k + ' --> '  # + str(v)
+            msg += "\n  " + "\n  ".join(v)
+    except known_exceptions as answer:
+        problem = mdaFile + '\n' + traceback.format_exc()
+        msg += '\n* ' + problem
+    return msg
+
+
 def main():
     '''presents the GUI'''
     parser = optparse.OptionParser(description=__description__)
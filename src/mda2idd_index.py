@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+'''
+Persistent index of the MDA file headers in a directory
+
+The header information of every MDA file in a directory (scan number,
+rank, dimensions, time stamps, positioner and detector names, ...)
+is kept in a sidecar file (``.mda2idd_index.json``) in that directory.
+Each entry is keyed by the file name and is valid while the size and
+modification time of the file do not change.  Only new or changed
+files are read again, so listing or summarizing a directory with
+thousands of MDA files is a single read of the index file.
+
+If the index file cannot be written (read-only directory), the index
+is kept in memory only.  A long-running program (such as the GUI) keeps
+changed indexes in memory and calls :func:`saveIndexes` now and then.
+
+
+---------------
+
+
+Source Code Documentation
+-------------------------
+
+.. autosummary::
+
+    ~DirectoryIndex
+    ~getIndex
+    ~skimMDA
+    ~saveIndexes
+    ~readEntry
+    ~readEntries
+    ~readJsonFile
+    ~writeJsonFile
+    ~writeFileAtomically
+
+--------------
+
+'''
+
+
+import glob
+import json
+import os
+import threading
+import mda
+
+
+INDEX_FILE = '.mda2idd_index.json'
+INDEX_VERSION = 1
+FILE_FILTER = '*.mda'
+READ_THREADS = 8    # MDA files read at once by readEntries()
+
+_indexes = {}   # DirectoryIndex objects, by absolute directory path
+_lock = threading.RLock()   # for _indexes and their entries, held only to look up or swap in
+_saveLock = threading.Lock()    # one index file written at a time
+
+
+def readJsonFile(filename):
+    '''return the object in JSON file ``filename`` or None if it cannot be read'''
+    try:
+        f = open(filename, 'r')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def writeJsonFile(filename, obj):
+    '''
+    write ``obj`` to JSON file ``filename``, replacing the file in one step
+
+    See :func:`writeFileAtomically`.
+    Byte strings are written as latin-1 (EPICS strings are not always UTF-8).
+    Raises IOError or OSError if the file cannot be written.
+    '''
+    writeFileAtomically(filename, json.dumps(obj, sort_keys=True, encoding='latin-1'))
+
+
+def writeFileAtomically(filename, text):
+    '''
+    write ``text`` to file ``filename``, replacing the file in one step
+
+    The text is written to a temporary file in the same directory
+    which is then renamed, so readers never see a partially-written file.
+    Raises IOError or OSError if the file cannot be written
+    (the temporary file is removed).
+    '''
+    tempname = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        f = open(tempname, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        try:
+            os.rename(tempname, filename)
+        except OSError:
+            # Windows will not rename onto an existing file
+            if not os.path.exists(filename):
+                raise
+            os.remove(filename)
+            os.rename(tempname, filename)
+    except (IOError, OSError):
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+
+
+def _describe(items, attributes):
+    return [[getattr(item, a) for a in attributes] for item in items]
+
+
+def _makeEntry(mdaFileName, st):
+    '''read the headers of one MDA file into an index entry'''
+    entry = dict(size=st.st_size, mtime=st.st_mtime)
+    try:
+        dim = mda.readMDAHeaders(mdaFileName)
+    except Exception as exc:
+        entry['error'] = str(exc)
+        return entry
+    head = dim[0]
+    for key in ('version', 'scan_number', 'rank', 'dimensions', 'isRegular'):
+        entry[key] = head[key]
+    entry['scans'] = [
+        dict(
+            name = scan.name,
+            time = scan.time,
+            rank = scan.rank,
+            npts = scan.npts,
+            curr_pt = scan.curr_pt,
+            np = scan.np,
+            nd = scan.nd,
+            nt = scan.nt,
+            positioners = _describe(scan.p, ('fieldName', 'name', 'desc', 'unit')),
+            detectors = _describe(scan.d, ('fieldName', 'name', 'desc', 'unit')),
+            triggers = _describe(scan.t, ('name', 'command')),
+        )
+        for scan in dim[1:]
+    ]
+    return entry
+
+
+def readEntry(mdaFileName):
+    '''
+    index entry of one MDA file, read from the file
+
+    For worker processes: the entry can be given to
+    :meth:`DirectoryIndex.setEntry` of the main process.
+    Raises OSError if the file does not exist.
+    '''
+    return _makeEntry(mdaFileName, os.stat(mdaFileName))
+
+
+def readEntries(mdaFileNames, threads=READ_THREADS):
+    '''
+    bring the index entries of many MDA files up to date, return the number read
+
+    Only new or changed files are read, several at once in threads
+    (see :func:`mda.skimMDAList`).  The index files are not written.
+    '''
+    stale = [name for name in mdaFileNames
+             if not getIndex(os.path.dirname(name) or os.curdir).isCurrent(name)]
+    for name, entry in zip(stale, mda.skimMDAList(stale, threads, readEntry)):
+        if entry is not None:   # None: the file is gone
+            getIndex(os.path.dirname(name) or os.curdir).setEntry(name, entry)
+    return len(stale)
+
+
+class DirectoryIndex(object):
+    '''
+    header information of all MDA files in one directory, kept in a sidecar file
+
+    :param str path: directory with MDA files
+    :param str file_filter: glob pattern of the MDA files (default: ``*.mda``)
+    '''
+
+    def __init__(self, path, file_filter=FILE_FILTER):
+        self.path = os.path.abspath(path)
+        self.file_filter = file_filter
+        self.filename = os.path.join(self.path, INDEX_FILE)
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        '''(re)read the sidecar file, ignoring it if missing or from another version'''
+        content = readJsonFile(self.filename)
+        if isinstance(content, dict) and content.get('version') == INDEX_VERSION:
+            self.entries = content.get('files', {})
+        else:
+            self.entries = {}
+        self.dirty = False
+
+    def save(self):
+        '''
+        write the sidecar file if anything changed, return True if it was written
+
+        The entries are copied under the module lock (entries are replaced,
+        never changed), then written without it, so other threads can
+        go on using the index.
+        '''
+        with _saveLock:
+            with _lock:
+                if not self.dirty:
+                    return False
+                files = dict(self.entries)
+                self.dirty = False
+            try:
+                writeJsonFile(self.filename, dict(version=INDEX_VERSION, files=files))
+            except (IOError, OSError):
+                self.dirty = True
+                return False    # read-only directory: keep the index in memory
+        return True
+
+    def files(self):
+        '''sorted list of the names of the MDA files in the directory'''
+        return sorted([os.path.basename(name)
+                       for name in glob.glob(os.path.join(self.path, self.file_filter))])
+
+    def entry(self, name):
+        '''
+        index entry of MDA file ``name`` (in this directory), read again if stale
+
+        Returns None if the file does not exist.
+        '''
+        name = os.path.basename(name)
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            if name in self.entries:
+                del self.entries[name]
+                self.dirty = True
+            return None
+        entry = self.entries.get(name)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            entry = _makeEntry(os.path.join(self.path, name), st)
+            self.entries[name] = entry
+            self.dirty = True
+        return entry
+
+    def isCurrent(self, name):
+        '''True if the index entry of MDA file ``name`` is up to date'''
+        name = os.path.basename(name)
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return False
+        return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+    def setEntry(self, name, entry):
+        '''store an entry from :func:`readEntry` for MDA file ``name``'''
+        with _lock:
+            self.entries[os.path.basename(name)] = entry
+            self.dirty = True
+
+    def update(self):
+        '''
+        bring the index up to date with the directory, return names of changed files
+
+        Only new or changed files are read.  Entries of deleted files are dropped.
+        '''
+        changed = []
+        names = self.files()
+        for name in names:
+            old = self.entries.get(name)
+            if self.entry(name) is not old:
+                changed.append(name)
+        for name in set(self.entries.keys()) - set(names):
+            del self.entries[name]
+            self.dirty = True
+        return changed
+
+    def skimMDA(self, name):
+        '''
+        same result as :func:`mda.skimMDA`, built from the index entry
+
+        The ``plower_scans`` offset tables are not kept in the index.
+        Raises IOError if the file could not be read.
+        '''
+        return _skimEntry(name, self.entry(name))
+
+
+def _skimEntry(name, entry):
+    ''':func:`mda.skimMDA` result of MDA file ``name`` from its index entry'''
+    if entry is None:
+        return None
+    if 'error' in entry:
+        raise IOError(str(entry['error']))
+    numDims = min(entry['rank'], 4)
+    scans = entry['scans'][:numDims]
+    if len(scans) < numDims or 0 in [s['curr_pt'] for s in scans]:
+        return None     # mda.skimMDA() needs data in each dimension
+
+    dimensions = entry['dimensions']
+    if len(dimensions) > 2:
+        dimensions = tuple(dimensions)  # as the XDR unpacker returns it
+    head = dict(
+        filename = name,
+        version = entry['version'],
+        scan_number = entry['scan_number'],
+        rank = entry['rank'],
+        dimensions = dimensions,
+        acquired_dimensions = [s['curr_pt'] for s in scans],
+        isRegular = entry['isRegular'],
+    )
+    dim = [head]
+    for dimNum, s in enumerate(scans):
+        scan = mda.scanDim()
+        for key in ('rank', 'npts', 'curr_pt', 'np', 'nd', 'nt'):
+            setattr(scan, key, s[key])
+        scan.name = s['name'].encode('latin-1')
+        scan.time = s['time'].encode('latin-1')
+        scan.dim = dimNum + 1
+        dim.append(scan)
+    return dim
+
+
+def getIndex(path):
+    '''the :class:`DirectoryIndex` of directory ``path`` (one object per directory)'''
+    path = os.path.abspath(path)
+    with _lock:
+        index = _indexes.get(path)
+    if index is None:
+        index = DirectoryIndex(path)    # reads the index file, without the lock
+        with _lock:
+            index = _indexes.setdefault(path, index)
+    return index
+
+
+def skimMDA(mdaFileName, save=True):
+    '''
+    :func:`mda.skimMDA` through the index of the file's directory
+
+    May be called from any thread: the MDA file is read without the
+    module lock, which is taken only to swap the new entry in.
+    The index file is written when the entry had to be (re)read,
+    unless ``save`` is False (then the caller calls
+    :meth:`DirectoryIndex.save` once, after many files,
+    or :func:`saveIndexes` now and then).
+    '''
+    index = getIndex(os.path.dirname(mdaFileName) or os.curdir)
+    name = os.path.basename(mdaFileName)
+    try:
+        st = os.stat(mdaFileName)
+    except OSError:
+        st = None
+    with _lock:
+        entry = index.entries.get(name)
+        if st is None and entry is not None:
+            del index.entries[name]
+            index.dirty = True
+    if st is None:
+        return None
+    if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+        entry = _makeEntry(mdaFileName, st)
+        index.setEntry(name, entry)
+        if save:
+            index.save()
+    return _skimEntry(name, entry)
+
+
+def saveIndexes():
+    '''
+    write the index files of all directories used by :func:`skimMDA` that changed
+
+    May be called from any thread.  Returns the number of index files written.
+    '''
+    with _lock:
+        indexes = _indexes.values()
+    return len([index for index in indexes if index.save()])
@@ -43,6 +43,9 @@ Internal (but interesting) Methods
 * :func:`columnsToText()`:
   convert a list of column lists into rows of text
 
+* :func:`writeTables()`:
+  write tables of columns to files, a block of rows at a time
+
 Dependencies
 ------------
 
@@ -86,10 +89,18 @@ Source Code Documentation
     ~report
     ~report_1d
     ~report_2d
+    ~tables_1d
+    ~tables_2d
+    ~FormattedColumn
     ~columnsToText
+    ~writeTables
+    ~writeTable
+    ~writeTableFiles
+    ~tablesToText
     ~writeOutput
     ~getAsciiFileName
     ~getAsciiPath
+    ~Manifest
     ~report_list
 
 --------------
@@ -97,16 +108,27 @@ Source Code Documentation
 '''
 
 
+import collections
 import glob
+import hashlib
+import multiprocessing
 import os
 import optparse
+import StringIO
 import mda
+import mda2idd_index
 
 
 ROW_INDEX_FORMAT = '%5d'
+TABLE_BLOCK_CELLS = 100000      # writeTables() formats this many table cells at a time
 
 __description__ = "Generate ASCII text files from MDA files for APS station 2-ID-D"
 
+# change this when the content of the ASCII files changes,
+# so an incremental conversion writes all the files again
+CONVERTER_VERSION = 1
+MANIFEST_FILE = '.mda2idd_manifest.json'
+
 
 def summaryMda(mdaFileName):
     '''
@@ -202,7 +224,8 @@ def report(mdaFileName, allowException=False):
 
     asciiPath = getAsciiPath(mdaFileName)
 
-    data = mda.readMDA(mdaFileName)
+    # the EPICS PVs are not reported
+    data = mda.readMDA(mdaFileName, readQuick=True, env=False)
     if data is None:
         msg = "could not read data from MDA file: " + mdaFileName
         if allowException:
@@ -215,9 +238,10 @@ def report(mdaFileName, allowException=False):
 
     if rank in (1, 2):
         if len(data[0]['acquired_dimensions']) == rank:
-            method = {1: report_1d, 2: report_2d}[rank]
-            for key, value in method(data).items():
-                writeOutput(asciiPath, key, value)
+            method = {1: tables_1d, 2: tables_2d}[rank]
+            shared, tables = method(data)
+            writeTableFiles(asciiPath, shared, tables)
+            for key, header, columns in tables:
                 if mdaFileName not in converted:
                     converted[mdaFileName] = []
                 converted[mdaFileName].append( os.path.join(asciiPath, key) )
@@ -260,6 +284,16 @@ def report_1d(data):
          5               1203.47            122.777            169.000             ...
 
     '''
+    return tablesToText(*tables_1d(data))
+
+
+def tables_1d(data):
+    '''
+    header and columns of the :func:`report_1d()` table
+    
+    :returns ([], [(str, [str], [column])]): no shared columns, and
+        file name, header lines, and columns (see :func:`writeTables()`)
+    '''
     header = [ ';', ]
     header.append( '; %s' % ('='*55) )
     header.append( '; Filename: %s' % data[0]['filename'] )
@@ -273,7 +307,7 @@ def report_1d(data):
     header.append( '; timeStamp= %s' % data[1].time.split('.')[0] )
     header.append( '; comment= ' )
     
-    # build the table, one column at a time, then use zip to transpose the table to rows
+    # build the table, one column at a time
     columns = []
     columns.append(
         ['; %-5s ' % (item+':') for item in ('DIS', 'Name', 'Desc', 'Unit')]
@@ -282,13 +316,10 @@ def report_1d(data):
     for part in (data[1].p, data[1].d):  # positioners, then detectors
         for item in part:
             columns.append(
-                [item.fieldName, item.name, item.desc, item.unit]
-              + [str(_) for _ in item.data]
+                FormattedColumn([item.fieldName, item.name, item.desc, item.unit], item.data)
             )
     
-    # return value is a dictionary:
-    #   key is file name, value is file contents
-    return { getAsciiFileName(data): '\n'.join(header) + '\n' + columnsToText(columns)  }
+    return [], [ (getAsciiFileName(data), header, columns) ]
 
 
 def report_2d(data):
@@ -309,52 +340,280 @@ def report_2d(data):
          3          1290.55         0.00000         0.00000         0.00000         0.00000        ...
 
     '''
+    # return value is a dictionary:
+    #   keys are file names, values are file contents
+    return tablesToText(*tables_2d(data))
+
+
+def tables_2d(data):
+    '''
+    headers and columns of the :func:`report_2d()` tables, one for each detector
+    
+    The Xindex and Xvalue columns are the same in all tables.  They are
+    built once and returned separately, as the shared columns.
+    
+    :returns ([column], [(str, [str], [column])]): shared columns, and for each detector:
+        file name, header lines, and detector columns (see :func:`writeTables()`)
+    '''
+    if data[2].nd == 0:
+        return [], []       # no detectors, no tables
     scanNum = data[0]['scan_number']
-    output = {}
+    num_cols = data[1].curr_pt
+    num_rows = data[2].curr_pt
+
+    # build the table, one column at a time
+    shared = []
+    row = [';', ';', '; Xindex,']
+    row += [ROW_INDEX_FORMAT % (rownum+1) for rownum in range(num_rows)]
+    # if len(???) < ???:
+    #     pass            # TODO: extend (pad) when curr_pt < npts !
+    shared.append(row)
+
+    head = ['Yvalue:', 'Yindex', 'Xvalue,']
+    if len(data[2].p) > 0:
+        shared.append(FormattedColumn(head, data[2].p[0].data[0]))
+        if len(data[2].p[0].data[0]) < data[2].npts:
+            pass            # TODO: extend (pad) when curr_pt < npts !
+    else:
+        # no positioners at this dimension, make up some column labels
+        shared.append(head + [str(item+1) for item in range(data[2].npts)])
+
+    heads = []
+    for colNum in range(num_cols):
+        img_title = {False: 'Image', True: ''}[colNum > 0]
+        if len(data[1].p) == 0:
+            heads.append([str(colNum+1), str(colNum+1), img_title])
+        else:
+            heads.append([str(data[1].p[0].data[colNum]), str(colNum+1), img_title])
+
+    tables = []
     for detNum in range(data[2].nd):
         asciiFile = getAsciiFileName(data, detNum=detNum)
 
-        num_cols = data[1].curr_pt
-        num_rows = data[2].curr_pt
-
         header = [ '; FILE:  %s' % data[0]['filename'], ]
         header.append(  '; Title:  Image#%d (%s) - %s' % (detNum+1, data[2].d[detNum].name, data[2].d[detNum].fieldName) )
         header.append( '; Scan # = %8d ,  Detector # = %8d ,  col= %8d ,  row= %8d' % (scanNum, detNum+1, num_cols, num_rows ) )
 
-        # build the table, one column at a time, then use zip to transpose the table to rows
         columns = []
-        row = [';', ';', '; Xindex,']
-        row += [ROW_INDEX_FORMAT % (rownum+1) for rownum in range(num_rows)]
-        # if len(???) < ???:
-        #     pass            # TODO: extend (pad) when curr_pt < npts !
-        columns.append(row)
-
-        row = ['Yvalue:', 'Yindex', 'Xvalue,']
-        if len(data[2].p) > 0:
-            row += [str(item) for item in data[2].p[0].data[0]]
-            if len(data[2].p[0].data[0]) < data[2].npts:
-                pass            # TODO: extend (pad) when curr_pt < npts !
-        else:
-            # no positioners at this dimension, make up some column labels
-            row += [str(item+1) for item in range(data[2].npts)]
-        columns.append(row)
-
         for colNum in range(num_cols):
-            img_title = {False: 'Image', True: ''}[colNum > 0]
-            if len(data[1].p) == 0:
-                row = [str(colNum+1), str(colNum+1), img_title]
-            else:
-                row = [str(data[1].p[0].data[colNum]), str(colNum+1), img_title]
-            row += [str(item) for item in data[2].d[detNum].data[colNum]]
+            columns.append(FormattedColumn(heads[colNum], data[2].d[detNum].data[colNum]))
             if len(data[2].d[detNum].data[colNum]) < data[2].npts:
                 pass            # TODO: extend (pad) when curr_pt < npts !
-            columns.append(row)
 
-        output[asciiFile] = '\n'.join(header) + '\n' + columnsToText(columns) 
+        tables.append( (asciiFile, header, columns) )
+
+    return shared, tables
+
+
+class FormattedColumn(object):
+    '''
+    table column of text header cells followed by numbers, formatted with str() when used
     
-    # return value is a dictionary:
-    #   keys are file names, values are file contents
-    return output
+    Behaves like the list of the (formatted) cells of the column
+    but does not keep the formatted text.  The numbers are formatted
+    in bulk by :func:`writeTables()`, never one cell at a time.
+    A NumPy array is converted to a list first, so the text is the
+    same as from the lists of floats that :func:`mda.readMDA()` returns.
+    
+    :param [str] head: header cells
+    :param [float] values: numbers
+    '''
+    
+    def __init__(self, head, values):
+        self.head = head
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        self.values = values
+    
+    def __len__(self):
+        return len(self.head) + len(self.values)
+    
+    def __getitem__(self, index):
+        if index < len(self.head):
+            return self.head[index]
+        return str(self.values[index - len(self.head)])
+    
+    def cells(self, start, stop):
+        '''list of cells start..stop-1: header text, then numbers (not formatted)'''
+        numHead = len(self.head)
+        cells = list(self.head[start:stop])
+        if stop > numHead:
+            cells += self.values[max(start - numHead, 0):stop - numHead]
+        return cells
+    
+    def text(self):
+        '''list of all cells, formatted'''
+        return list(self.head) + map(str, self.values)
+    
+    def width(self):
+        '''largest character width of the column cells'''
+        return max(map(len, self.head) + map(len, map(str, self.values)))
+
+
+def columnWidth(column):
+    '''largest character width of the cells of a column (list of str or :class:`FormattedColumn`)'''
+    if isinstance(column, FormattedColumn):
+        return column.width()
+    return max(map(len, column))
+
+
+def columnText(column):
+    '''list of the formatted cells of a column (list of str or :class:`FormattedColumn`)'''
+    if isinstance(column, FormattedColumn):
+        return column.text()
+    return column
+
+
+def columnCells(column, start, stop):
+    '''cells start..stop-1 of a column (list of str or :class:`FormattedColumn`)'''
+    if isinstance(column, FormattedColumn):
+        return column.cells(start, stop)
+    return column[start:stop]
+
+
+def columnsFormat(columns):
+    '''row format that left-aligns each column to its largest width'''
+    sep = ' '*2
+    return sep.join(['%%-%ds' % item for item in map(columnWidth, columns)])
+
+
+def writeTables(outputs, shared):
+    '''
+    write tables that start with the same columns, each to its own file object, in one pass
+    
+    Each table is written as :func:`writeTable()` would write it, with
+    the shared columns followed by the table's own columns.  The widths
+    of the shared columns, and the text of their part of each row,
+    are computed only once for all tables.
+    
+    Column widths are found in a first pass over the columns, then
+    the rows of all tables are formatted and written in blocks of about
+    :data:`TABLE_BLOCK_CELLS` cells (of one table), so only one block of
+    text is kept in memory.  Numbers are formatted by the row format itself
+    (``%-Ns`` uses str()), with one format operation per row.
+    Tables no larger than one block are formatted only once.
+    The text does not end with a line separator.
+    
+    :param [(obj, [str], [column])] outputs: for each table: file object open for writing,
+        header lines, and the table's own columns
+    :param [column] shared: first columns of every table
+    
+    A column is a list of str or a :class:`FormattedColumn`.
+    '''
+    for f, header, columns in outputs:
+        for line in header:
+            f.write(line + '\n')
+    outputs = [output for output in outputs if len(shared) + len(output[2]) > 0]
+    if len(outputs) == 0:
+        return
+
+    # shared columns: widths (and, if not too large, text of each row) only once
+    shared_cells = sum(map(len, shared))
+    if shared_cells <= TABLE_BLOCK_CELLS:
+        shared = map(columnText, shared)
+    sharedFormat = columnsFormat(shared)
+    prefixes = None
+    if len(shared) > 0 and shared_cells <= TABLE_BLOCK_CELLS:
+        # zip(*columns) : matrix transpose
+        prefixes = [sharedFormat % row for row in zip(*shared)]
+
+    tables = []
+    for f, header, columns in outputs:
+        # as zip(*columns) would: stop at the end of the shortest column
+        num_rows = min(map(len, shared) + map(len, columns))
+        if shared_cells + sum(map(len, columns)) <= TABLE_BLOCK_CELLS:
+            # small table: format each cell once and write it now
+            columns = map(columnText, columns)
+            f.write('\n'.join(joinRows(columnsFormat(columns), columns, prefixes, num_rows)))
+        else:
+            tables.append( (f, columnsFormat(columns), columns, num_rows) )
+    if len(tables) == 0:
+        return
+
+    # large tables: one block of rows of one table at a time
+    num_columns = len(shared) + max([len(table[2]) for table in tables])
+    block_rows = max(1, TABLE_BLOCK_CELLS // num_columns)
+    all_rows = max([table[3] for table in tables])
+    for start in range(0, all_rows, block_rows):
+        stop = min(start + block_rows, all_rows)
+        if len(shared) == 0:
+            block_prefixes = None
+        elif prefixes is not None:
+            block_prefixes = prefixes[start:stop]
+        else:
+            block = [columnCells(column, start, stop) for column in shared]
+            block_prefixes = [sharedFormat % row for row in zip(*block)]
+        for f, fmt, columns, num_rows in tables:
+            if start >= num_rows:
+                continue
+            block = [columnCells(column, start, min(stop, num_rows)) for column in columns]
+            if start > 0:
+                f.write('\n')
+            f.write('\n'.join(joinRows(fmt, block, block_prefixes, min(stop, num_rows) - start)))
+
+
+def joinRows(fmt, block, prefixes, num_rows):
+    '''
+    text of the rows of a block of columns, each row preceded by its prefix (if any)
+    
+    :param str fmt: row format of the block's columns
+    :param [[obj]] block: list of columns, each a list of cells
+    :param [str] prefixes: text of the shared columns of each row, or None
+    :param int num_rows: number of rows
+    :returns [str]: text of each row
+    '''
+    if len(block) == 0:
+        return prefixes[:num_rows]
+    # zip(*block) : matrix transpose
+    rows = [fmt % row for row in zip(*block)][:num_rows]
+    if prefixes is not None:
+        sep = ' '*2
+        rows = [prefix + sep + row for prefix, row in zip(prefixes, rows)]
+    return rows
+
+
+def writeTable(f, header, columns):
+    '''
+    write header lines and a table of columns as text to file object f
+    
+    Same text as :func:`columnsToText()`, preceded by the header lines.
+    See :func:`writeTables()` for how the table is written.
+    
+    :param obj f: file object open for writing
+    :param [str] header: header lines
+    :param [column] columns: list of columns, each a list of str or a :class:`FormattedColumn`
+    '''
+    writeTables([(f, header, columns)], [])
+
+
+def writeTableFiles(path, shared, tables):
+    '''
+    write tables (see :func:`writeTables()`) to files, as :func:`writeOutput()` writes text
+    
+    :param str path: directory where the files should be written
+    :param [column] shared: first columns of every table
+    :param [(str, [str], [column])] tables: file name, header lines, and the table's own columns
+    '''
+    if os.path.exists(path):
+        files = []
+        try:
+            for filename, header, columns in tables:
+                files.append(open(os.path.join(path, filename), 'w'))
+            writeTables([(f, header, columns) for f, (filename, header, columns) in zip(files, tables)], shared)
+        finally:
+            for f in files:
+                f.close()
+
+
+def tablesToText(shared, tables):
+    '''
+    text of tables (see :func:`writeTables()`)
+    
+    :returns dict: keys are file names, values are file contents
+    '''
+    files = [StringIO.StringIO() for table in tables]
+    writeTables([(f, header, columns) for f, (filename, header, columns) in zip(files, tables)], shared)
+    return dict([(table[0], f.getvalue()) for f, table in zip(files, tables)])
 
 
 def columnsToText(columns):
@@ -374,14 +633,9 @@ def columnsToText(columns):
         2A  2B          2C
     
     '''
-    # get the largest width for each column
-    widths = [max(map(len, item)) for item in columns]
-    # left-align each column
-    sep = ' '*2
-    fmt = sep.join(['%%-%ds' % item for item in widths])
-    # rows = zip(*columns) : matrix transpose
-    result = [fmt % tuple(row) for row in zip(*columns)]
-    return '\n'.join(result)
+    f = StringIO.StringIO()
+    writeTable(f, [], columns)
+    return f.getvalue()
 
 
 def writeOutput(path, filename, output):
@@ -439,7 +693,10 @@ def getAsciiPath(mdaFileName):
     mdaPath = os.path.dirname(mdaFileName)
     asciiPath = os.path.join(mdaPath, '..', 'ASCII')
     if not os.path.exists(asciiPath):
-        os.makedirs(asciiPath)
+        try:
+            os.makedirs(asciiPath)
+        except OSError:
+            pass    # might have been created meanwhile by another process
         if not os.path.exists(asciiPath):
             #raise OSError("could not create ASCII subdirectory, does not exist either")
             asciiPath = mdaPath
@@ -458,18 +715,167 @@ def developer_test():
                 print key, '-->', ', '.join(sorted(value))
 
 
-def report_list(mdaFileList):
-    '''process a list of MDA files'''
-    for mdaFile in mdaFileList:
-        report(mdaFile)
+def fileHash(filename):
+    '''MD5 hash of the content of a file'''
+    md5 = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            md5.update(block)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+
+class Manifest(object):
+    '''
+    record of the MDA files converted into one ASCII directory
+    
+    Used by :func:`report_list()` to convert only new or changed files.
+    For each MDA file, the manifest keeps the size, modification time
+    and MD5 hash of the file, the :data:`CONVERTER_VERSION`, and the
+    names of the ASCII files written.  The hash is only computed when
+    the size or modification time changed.
+    
+    :param str asciiPath: directory of the ASCII files (from :func:`getAsciiPath()`)
+    '''
+    
+    def __init__(self, asciiPath):
+        self.path = asciiPath
+        self.filename = os.path.join(asciiPath, MANIFEST_FILE)
+        content = mda2idd_index.readJsonFile(self.filename)
+        self.entries = content if isinstance(content, dict) else {}
+        self.pending = {}   # (size, mtime, md5) of MDA files to be converted
+        self.dirty = False
+    
+    def isCurrent(self, mdaFileName):
+        '''True if the ASCII files from this MDA file are up to date'''
+        st = os.stat(mdaFileName)
+        md5 = None
+        entry = self.entries.get(os.path.basename(mdaFileName))
+        if entry is not None and entry['version'] == CONVERTER_VERSION:
+            outputs = [os.path.join(self.path, name) for name in entry['outputs']]
+            if False not in map(os.path.exists, outputs):
+                if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                    return True
+                md5 = fileHash(mdaFileName)
+                if md5 == entry['md5']:
+                    # touched but not changed
+                    entry['size'], entry['mtime'] = st.st_size, st.st_mtime
+                    self.dirty = True
+                    return True
+        self.pending[mdaFileName] = (st.st_size, st.st_mtime, md5 or fileHash(mdaFileName))
+        return False
+    
+    def record(self, mdaFileName, asciiFileList):
+        '''remember the ASCII files written from an MDA file checked by :meth:`isCurrent()`'''
+        size, mtime, md5 = self.pending.pop(mdaFileName)
+        self.entries[os.path.basename(mdaFileName)] = dict(
+            size = size,
+            mtime = mtime,
+            md5 = md5,
+            version = CONVERTER_VERSION,
+            outputs = [os.path.basename(name) for name in asciiFileList],
+        )
+        self.dirty = True
+    
+    def save(self):
+        '''write the manifest file if anything changed'''
+        if self.dirty:
+            try:
+                mda2idd_index.writeJsonFile(self.filename, self.entries)
+                self.dirty = False
+            except (IOError, OSError):
+                pass    # next time, these files will be converted again
+
+
+def _report_job(mdaFileName):
+    '''
+    :func:`report()` of one MDA file in a worker process
+    
+    :returns (dict, str): converted files and the message report() would have printed
+    '''
+    try:
+        return report(mdaFileName, allowException=True), None
+    except (ReadMdaException, RankException) as exc:
+        return {}, str(exc)
+
+
+def report_list(mdaFileList, jobs=1, incremental=False):
+    '''
+    process a list of MDA files
+    
+    :param [str] mdaFileList: names of MDA files
+    :param int jobs: number of worker processes, 1 (default): this process, 0: one per CPU
+    :param bool incremental: only convert MDA files not converted before
+        (or changed since, see :class:`Manifest`)
+    :returns dict: {mdaFileName: [asciiFileName]} of all converted files
+    '''
+    converted = {}
+    manifests = {}      # by ASCII directory
+    if incremental:
+        todo = []
+        for mdaFile in mdaFileList:
+            if not os.path.exists(mdaFile):
+                continue
+            asciiPath = getAsciiPath(mdaFile)
+            if asciiPath not in manifests:
+                manifests[asciiPath] = Manifest(asciiPath)
+            if not manifests[asciiPath].isCurrent(mdaFile):
+                todo.append((mdaFile, manifests[asciiPath]))
+    else:
+        todo = [(mdaFile, None) for mdaFile in mdaFileList]
+
+    def done(mdaFile, manifest, result):
+        converted.update(result)
+        if manifest is not None:
+            manifest.record(mdaFile, result.get(mdaFile, []))
+
+    if jobs < 1:
+        jobs = multiprocessing.cpu_count()
+    try:
+        if jobs == 1 or len(todo) < 2:
+            for mdaFile, manifest in todo:
+                done(mdaFile, manifest, report(mdaFile))
+            return converted
+
+        # keep only a few files per worker in flight, collect results in order
+        pool = multiprocessing.Pool(jobs)
+        pending = collections.deque()
+
+        def collect():
+            mdaFile, manifest, job = pending.popleft()
+            result, msg = job.get()
+            if msg is not None:
+                print msg
+            done(mdaFile, manifest, result)
+
+        try:
+            for mdaFile, manifest in todo:
+                if len(pending) >= 2*jobs:
+                    collect()
+                pending.append((mdaFile, manifest, pool.apply_async(_report_job, (mdaFile,))))
+            while len(pending) > 0:
+                collect()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        for manifest in manifests.values():
+            manifest.save()
+    return converted
 
 
 def main():
     '''handles command-line input'''
     usage = 'usage: %prog [options] mdaFile [mdaFile ...]'
     parser = optparse.OptionParser(description=__description__, usage=usage)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='number of files to convert in parallel (0: one per CPU, default: %default)')
+    parser.add_option('-i', '--incremental', dest='incremental', action='store_true', default=False,
+                      help='convert only MDA files that are new or changed since they were last converted')
     options, args = parser.parse_args()
-    report_list(args)
+    report_list(args, jobs=options.jobs, incremental=options.incremental)
 
 
 if __name__ == '__main__':
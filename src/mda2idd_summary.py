@@ -13,6 +13,10 @@ Source Code Documentation
 .. autosummary::
 
     ~summaryMda
+    ~readSummary
+    ~summaryText
+    ~catalogRecord
+    ~CatalogWriter
     ~summary_list
 
 --------------
@@ -20,12 +24,21 @@ Source Code Documentation
 '''
 
 
+import collections
+import csv
+import json
+import multiprocessing
 import optparse
 import os
+import sys
 import mda
+import mda2idd_index
 
 
 ROW_INDEX_FORMAT = '%5d'
+CATALOG_FIELDS = ('file', 'scan_number', 'rank', 'dimensions', 'acquired_dimensions',
+                  'time', 'positioners', 'detectors', 'triggers', 'pvs', 'error')
+SKIM_CHUNK = 64     # short report, one process: files whose headers are read together
 
 __description__ = "Generate ASCII text summary of MDA files for APS station 2-ID-D"
 __svnid__ = "$Id$"
@@ -38,20 +51,44 @@ def summaryMda(mdaFileName, shortReport = True):
     Developed for the GUI to give the user a preview of the file
     before saving its data as ASCII to a text file.
     '''
+    return readSummary(mdaFileName, shortReport)[1]
+
+
+def readSummary(mdaFileName, shortReport = True, saveIndex = True):
+    '''
+    read an MDA file for its summary, return ``(data, text)``
+    
+    ``data`` is the header information read from the file
+    (None if it could not be read) and ``text`` is
+    the summary of :func:`summaryMda` (or the reason there is none).
+    With ``saveIndex=False``, a changed directory index is not written
+    (see :func:`mda2idd_index.skimMDA`).
+    '''
     if not os.path.exists(mdaFileName):
-        return ''
+        return None, ''
     
     if 'skimMDA' in mda.__dict__:
-        reportType = {True: mda.skimMDA, False: mda.readMDA}[shortReport]
+        # the short report comes from the directory's header index,
+        # MdaFile reads the headers and EPICS PVs but no scan data
+        if shortReport:
+            reportType = lambda name: mda2idd_index.skimMDA(name, save=saveIndex)
+        else:
+            reportType = mda.MdaFile
     else:
         reportType = mda.readMDA	# /APSshare/bin/python's mda does not have skimMDA
     try:
         data = reportType(mdaFileName) # just the header info
     except Exception as report:
-        return "problem with %s: %s" % (mdaFileName, str(report))
+        return None, "problem with %s: %s" % (mdaFileName, str(report))
     if data is None:
-        return "could not read: " + mdaFileName
-    
+        return None, "could not read: " + mdaFileName
+    if hasattr(data, 'close'):
+        data.close()    # MdaFile: everything needed here has been read already
+    return data, summaryText(data)
+
+
+def summaryText(data):
+    '''text summary of the header information of an MDA file, as read by :func:`readSummary`'''
     headSection = data[0]
     summary = []
     summary.append( 'MDA version = %.1f' % headSection['version'] )
@@ -114,20 +151,199 @@ def summaryMda(mdaFileName, shortReport = True):
     return '\n'.join(summary)
 
 
-def summary_list(mdaFileList):
-    '''process a list of MDA files'''
-    for mdaFile in mdaFileList:
-        print "\n"+mdaFile
-        print "="*len(mdaFile) + "\n"
-        print summaryMda(mdaFile)
+def catalogRecord(mdaFileName, data, text):
+    '''
+    one row of the catalog table: the numbers that describe an MDA file
+    
+    :param str mdaFileName: name of the MDA file
+    :param data: header information from :func:`readSummary` (None if not read)
+    :param str text: summary from :func:`readSummary` (the problem if ``data`` is None)
+    :returns dict: keys are :data:`CATALOG_FIELDS`, lists have one item per dimension
+    '''
+    record = collections.OrderedDict([(key, None) for key in CATALOG_FIELDS])
+    record['file'] = mdaFileName
+    if data is None:
+        record['error'] = text or 'file not found'
+        return record
+    headSection = data[0]
+    scans = data[1:]
+    record['scan_number'] = headSection['scan_number']
+    record['rank'] = headSection['rank']
+    record['dimensions'] = list(headSection['dimensions'])
+    record['acquired_dimensions'] = [scan.curr_pt for scan in scans]
+    if len(scans) > 0:
+        record['time'] = scans[0].time
+    record['positioners'] = [scan.np for scan in scans]
+    record['detectors'] = [scan.nd for scan in scans]
+    record['triggers'] = [scan.nt for scan in scans]
+    if 'ourKeys' in headSection:
+        record['pvs'] = len([k for k in headSection if k not in headSection['ourKeys']])
+    return record
+
+
+def summarize(mdaFileName, shortReport = True, saveIndex = True):
+    '''``(text, record)``: summary text and :func:`catalogRecord` of one MDA file'''
+    data, text = readSummary(mdaFileName, shortReport, saveIndex)
+    return text, catalogRecord(mdaFileName, data, text)
+
+
+def _summary_job(mdaFileName, shortReport):
+    '''
+    work for one MDA file in a worker process of :func:`summary_list`
+    
+    :returns (dict, tuple): for the short report: the directory index entry,
+        the summary is made from it in the main process (which keeps the index);
+        otherwise: the result of :func:`summarize`
+    '''
+    if shortReport and 'skimMDA' in mda.__dict__:
+        try:
+            return mda2idd_index.readEntry(mdaFileName), None
+        except OSError:
+            pass    # file is gone: summarize() says so
+    return None, summarize(mdaFileName, shortReport)
+
+
+class CatalogWriter(object):
+    '''
+    write catalog records to a file, as CSV or as JSON lines
+    
+    :param obj f: open file
+    :param str tableFormat: ``csv`` (list items are separated by spaces) or ``json`` (one object per line)
+    '''
+    
+    def __init__(self, f, tableFormat='csv'):
+        self.f = f
+        self.tableFormat = tableFormat
+        if tableFormat == 'csv':
+            self.writer = csv.writer(f)
+            self.writer.writerow(CATALOG_FIELDS)
+        elif tableFormat != 'json':
+            raise ValueError('unknown table format: ' + str(tableFormat))
+    
+    def write(self, record):
+        '''write one record from :func:`catalogRecord`'''
+        if self.tableFormat == 'json':
+            self.f.write(json.dumps(record, encoding='latin-1') + '\n')
+        else:
+            row = []
+            for value in record.values():
+                if value is None:
+                    value = ''
+                elif isinstance(value, list):
+                    value = ' '.join(map(str, value))
+                row.append(value)
+            self.writer.writerow(row)
+
+
+def summary_list(mdaFileList, shortReport = True, jobs = 1, table = None, tableFormat = 'csv', text = True):
+    '''
+    process a list of MDA files
+    
+    The summaries are printed in the order of the list.  With more than
+    one job, files are read by a pool of worker processes, a few files
+    ahead of the one printed.  With one job, the headers for the short
+    report are read SKIM_CHUNK files at a time, a few at once in threads
+    (see :func:`mda2idd_index.readEntries`).
+    
+    :param [str] mdaFileList: names of MDA files
+    :param bool shortReport: brief header (default) or full summary
+    :param int jobs: number of worker processes, 1 (default): this process, 0: one per CPU
+    :param obj table: file to write the catalog table (see :func:`catalogRecord`), None: no table
+    :param str tableFormat: ``csv`` (default) or ``json`` (JSON lines)
+    :param bool text: print the summary text
+    '''
+    catalog = None
+    if table is not None:
+        catalog = CatalogWriter(table, tableFormat)
+    indexes = {}        # directory indexes used for the short report
+
+    def show(mdaFile, result):
+        summary, record = result
+        if text:
+            print "\n"+mdaFile
+            print "="*len(mdaFile) + "\n"
+            print summary
+        if catalog is not None:
+            catalog.write(record)
+
+    def summary(mdaFile):
+        if shortReport:
+            index = mda2idd_index.getIndex(os.path.dirname(mdaFile) or os.curdir)
+            indexes[index.path] = index
+        return summarize(mdaFile, shortReport, saveIndex=False)
+
+    if jobs < 1:
+        jobs = multiprocessing.cpu_count()
+    try:
+        if jobs == 1 or len(mdaFileList) < 2:
+            for start in range(0, len(mdaFileList), SKIM_CHUNK):
+                chunk = mdaFileList[start:start+SKIM_CHUNK]
+                if shortReport and 'skimMDA' in mda.__dict__:
+                    mda2idd_index.readEntries(chunk)    # new or changed files, a few at once
+                for mdaFile in chunk:
+                    show(mdaFile, summary(mdaFile))
+            return
+
+        # keep only a few files per worker in flight, show results in order
+        pool = multiprocessing.Pool(jobs)
+        pending = collections.deque()
+
+        def collect():
+            mdaFile, job = pending.popleft()
+            if job is None:
+                result = summary(mdaFile)
+            else:
+                entry, result = job.get()
+                if entry is not None:
+                    index = mda2idd_index.getIndex(os.path.dirname(mdaFile) or os.curdir)
+                    index.setEntry(mdaFile, entry)
+                    result = summary(mdaFile)
+            show(mdaFile, result)
+
+        try:
+            for mdaFile in mdaFileList:
+                if len(pending) >= 2*jobs:
+                    collect()
+                job = None
+                if not shortReport or not mda2idd_index.getIndex(
+                        os.path.dirname(mdaFile) or os.curdir).isCurrent(mdaFile):
+                    job = pool.apply_async(_summary_job, (mdaFile, shortReport))
+                pending.append((mdaFile, job))
+            while len(pending) > 0:
+                collect()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        for index in indexes.values():
+            index.save()
 
 
 def main():
     '''handles command-line input'''
     usage = 'usage: %prog [options] mdaFile [mdaFile ...]'
     parser = optparse.OptionParser(description=__description__, usage=usage, version=__svnid__)
+    parser.add_option('-l', '--long', dest='shortReport', action='store_false', default=True,
+                      help='full summary, with the EPICS PVs and scan descriptions')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='number of files to read in parallel (0: one per CPU, default: %default)')
+    parser.add_option('-t', '--table', dest='table', default=None,
+                      help='also write a catalog table to this file ("-": only the table, to stdout)')
+    parser.add_option('-f', '--format', dest='tableFormat', type='choice', choices=['csv', 'json'],
+                      default='csv', help='format of the catalog table: csv or json (lines) (default: %default)')
     options, args = parser.parse_args()
-    summary_list(args)
+    if options.table is None:
+        summary_list(args, options.shortReport, options.jobs)
+    elif options.table == '-':
+        summary_list(args, options.shortReport, options.jobs,
+                     sys.stdout, options.tableFormat, text=False)
+    else:
+        table = open(options.table, 'wb')
+        try:
+            summary_list(args, options.shortReport, options.jobs,
+                         table, options.tableFormat)
+        finally:
+            table.close()
 
 
 if __name__ == '__main__':
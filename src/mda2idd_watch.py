@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+'''
+Watch a directory and convert each MDA file to ASCII when its scan is finished
+
+Objectives
+------------
+
+While a scan is acquired, the *saveData* process rewrites its MDA file
+after each point of the outer dimension.  Rather than converting the
+whole directory again and again, the :class:`Watcher` notices new or
+grown MDA files and calls :func:`mda2idd_report.report()` once for
+each finished scan, within seconds of the end of the scan.
+
+A file is finished when its size has not changed between two looks
+and the outer dimension has all its points (``curr_pt == npts``),
+or when it has not changed for *settle* seconds (an aborted scan).
+If a converted file grows again, it is converted again.
+
+Changes are found with *inotify* (if the *pyinotify* package is
+installed) or by looking at the size and modification time of the
+MDA files every *interval* seconds.  Scan headers come from the
+directory's header index (:mod:`mda2idd_index`), so only changed files
+are opened.  Finished files wait in a bounded queue for the conversion
+thread; when the queue is full, watching pauses until there is room.
+Conversions are recorded in the ASCII directory's
+:class:`mda2idd_report.Manifest`, so files are not converted again
+when the watcher is restarted.
+
+Usage::
+
+    mda2idd_watch.py [options] mdaDirectory
+
+---------------
+
+
+Source Code Documentation
+-------------------------
+
+.. autosummary::
+
+    ~Watcher
+
+--------------
+
+'''
+
+
+import datetime
+import fnmatch
+import optparse
+import os
+import Queue
+import threading
+import time
+import mda2idd_index
+import mda2idd_report
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+__description__ = "Convert MDA files to ASCII as soon as their scans are finished"
+
+POLL_INTERVAL_S = 2.0   # seconds between looks at the directory
+SETTLE_TIME_S = 30.0    # seconds without change before an unfinished scan is converted
+QUEUE_SIZE = 16         # finished files waiting for conversion
+
+
+class Watcher(object):
+    '''
+    watch a directory of MDA files and convert each finished scan once
+
+    :param str path: directory with MDA files
+    :param float interval: seconds between looks at the directory
+    :param float settle: seconds without change before an unfinished scan is converted
+    :param int queue_size: most finished files waiting for conversion
+    :param obj callback: called (in the conversion thread) as ``callback(mdaFileName, converted)``
+        after each conversion, ``converted`` is the dictionary from :func:`mda2idd_report.report()`,
+        default: print the names of the ASCII files
+    '''
+
+    def __init__(self, path, interval=POLL_INTERVAL_S, settle=SETTLE_TIME_S,
+                 queue_size=QUEUE_SIZE, callback=None):
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.settle = settle
+        self.file_filter = mda2idd_index.FILE_FILTER
+        self.callback = callback or self.printResult
+        self.index = mda2idd_index.DirectoryIndex(self.path, self.file_filter)
+        self.queue = Queue.Queue(queue_size)
+        self.stopping = threading.Event()
+        self.observed = {}      # name: (size, mtime, time of last change)
+        self.finished = {}      # name: (size, mtime) when queued
+        self.changed = set()    # names reported by inotify
+        self.manifests = {}     # conversion thread only, by ASCII directory
+
+    def run(self):
+        '''watch and convert until :meth:`stop()` is called'''
+        worker = threading.Thread(target=self.convert, name='mda2idd_watch')
+        worker.setDaemon(True)
+        worker.start()
+        notifier = self.startNotifier()
+        names = self.index.files()     # first look: everything
+        try:
+            while not self.stopping.isSet():
+                self.look(names)
+                self.index.save()
+                if notifier is None:
+                    self.stopping.wait(self.interval)
+                    names = self.index.files()
+                else:
+                    if notifier.check_events(int(1000*self.interval)):
+                        notifier.read_events()
+                        notifier.process_events()
+                    names = sorted(self.changed | set(self.observed.keys()))
+                    self.changed.clear()
+        finally:
+            self.stopping.set()
+            if notifier is not None:
+                notifier.stop()
+            self.queue.put(None)        # wakes the conversion thread
+            worker.join()
+
+    def stop(self):
+        '''stop watching (may be called from another thread)'''
+        self.stopping.set()
+
+    def startNotifier(self):
+        '''inotify notifier for changes of MDA files, None if not available'''
+        if pyinotify is None:
+            return None
+        changed = self.changed
+        file_filter = self.file_filter
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if fnmatch.fnmatch(event.name, file_filter):
+                    changed.add(event.name)
+
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY | pyinotify.IN_MOVED_TO
+        wm.add_watch(self.path, mask)
+        return pyinotify.Notifier(wm, Handler(), timeout=int(1000*self.interval))
+
+    def look(self, names):
+        '''look at these MDA files, queue those with finished scans'''
+        now = time.time()
+        for name in names:
+            if self.stopping.isSet():
+                return
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                self.observed.pop(name, None)       # deleted
+                continue
+            state = (st.st_size, st.st_mtime)
+            if self.finished.get(name) == state:
+                continue            # no change since it was queued
+            previous = self.observed.get(name)
+            if previous is None or previous[:2] != state:
+                self.observed[name] = state + (now,)
+                continue            # changed: look again later
+            if self.isFinished(name) or now - previous[2] >= self.settle:
+                # blocks while the queue is full
+                while not self.stopping.isSet():
+                    try:
+                        self.queue.put(name, True, self.interval)
+                        break
+                    except Queue.Full:
+                        pass
+                self.finished[name] = state
+                del self.observed[name]
+
+    def isFinished(self, name):
+        '''True if all points of the outer dimension were acquired'''
+        entry = self.index.entry(name)
+        if entry is None or 'error' in entry or len(entry['scans']) == 0:
+            return False
+        outer = entry['scans'][0]
+        return outer['curr_pt'] == outer['npts']
+
+    def convert(self):
+        '''conversion thread: convert MDA files from the queue'''
+        while True:
+            name = self.queue.get()
+            if name is None or self.stopping.isSet():
+                return
+            mdaFile = os.path.join(self.path, name)
+            asciiPath = mda2idd_report.getAsciiPath(mdaFile)
+            if asciiPath not in self.manifests:
+                self.manifests[asciiPath] = mda2idd_report.Manifest(asciiPath)
+            manifest = self.manifests[asciiPath]
+            try:
+                if manifest.isCurrent(mdaFile):
+                    continue
+                converted = mda2idd_report.report(mdaFile)
+                manifest.record(mdaFile, converted.get(mdaFile, []))
+                manifest.save()
+            except Exception as exc:
+                converted = {}
+                print '%s: %s: %s' % (datetime.datetime.now(), mdaFile, str(exc))
+            self.callback(mdaFile, converted)
+
+    def printResult(self, mdaFileName, converted):
+        '''default callback: print the names of the ASCII files'''
+        for asciiFile in converted.get(mdaFileName, []):
+            print '%s: %s --> %s' % (datetime.datetime.now(), mdaFileName, asciiFile)
+
+
+def main():
+    '''handles command-line input'''
+    usage = 'usage: %prog [options] mdaDirectory'
+    parser = optparse.OptionParser(description=__description__, usage=usage)
+    parser.add_option('-i', '--interval', dest='interval', type='float', default=POLL_INTERVAL_S,
+                      help='seconds between looks at the directory (default: %default)')
+    parser.add_option('-s', '--settle', dest='settle', type='float', default=SETTLE_TIME_S,
+                      help='seconds without change before an unfinished scan is converted (default: %default)')
+    parser.add_option('-q', '--queue', dest='queue_size', type='int', default=QUEUE_SIZE,
+                      help='most finished files waiting for conversion (default: %default)')
+    options, args = parser.parse_args()
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error('need one MDA directory')
+    watcher = Watcher(args[0], options.interval, options.settle, options.queue_size)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
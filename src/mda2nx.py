@@ -19,7 +19,7 @@ import nxh5_lib
 def process(mdaFile):
     if os.path.exists(mdaFile):
         nxFile = os.path.splitext(mdaFile)[0] + os.path.extsep + 'h5'
-        data = mda.readMDA(mdaFile)
+        data = mda.MdaFile(mdaFile)     # data are decoded as each dataset is written
         scan_number = data[0]['scan_number']
         rank = data[0]['rank']
 
@@ -105,6 +105,7 @@ def process(mdaFile):
                                    EPICS_PV=pv)
         
         f.close()
+        data.close()
 
 
 def epics_pvs(data):